@@ -14,8 +14,9 @@ tarpitd.py - making a port into tarpit
 
 ## SYNOPSIS
 
-    tarpitd.py [-h] [-r RATE] [-c [FILE]]
+    tarpitd.py [-h] [-r RATE] [-c [FILE]] [-w N]
         [-s PATTERN:HOST:PORT [PATTERN:HOST:PORT ...]] [--manual]
+    tarpitd.py --convert-trace FILE
 
 ## DESCRIPTION
 
@@ -59,6 +60,18 @@ none` to disable it.
 The current implementation checks the first few bytes of the request to
 confirm that the client is using the corresponding protocol.
 
+#### `-w, --workers N`
+
+Run N worker processes that share the listening ports with `SO_REUSEPORT`.
+Overrides `workers` in the configuration file. See
+[tarpitd.conf(5)](./tarpitd.conf.5.md).
+
+#### `--convert-trace FILE`
+
+Convert a binary client trace (see `client_trace_format` in
+[tarpitd.conf(5)](./tarpitd.conf.5.md)) to jsonl, and write it to stdout. The
+file is read one block at a time, so it may be larger than memory.
+
 #### `--manual MANUAL`
 
 Display the built-in manual page. By default, tarpitd.py will open
@@ -90,6 +103,12 @@ Responds to the client with a small HTML page containing many links and a
 dead-loop script. Browsers that support JavaScript will get stuck, and those
 links may cause crawlers to repeatedly pull the webpage.
 
+Set `maze` to `true` in the configuration file to turn the links into an
+endless maze for crawlers. Every path gets its own page, derived from a keyed
+hash of the path, so the same path always gets the same page and every page
+links to 300 more. Pages are generated on demand, and only the `maze_cache`
+(default `256`) most recently requested ones are kept in memory.
+
 #### http_deflate_html_bomb
 
 Tested with: Firefox, Chromium
@@ -114,6 +133,25 @@ implementation sends a compressed 1 MB file that decompresses to approximately
 Note: The deflate compression algorithm has its maximum compression rate limit
 at 1030.3:1.
 
+#### http_deflate_stream_bomb
+
+Like http_deflate_size_bomb, but the compressed stream never ends. It is sent
+with `Transfer-Encoding: chunked` and without `Content-Length`, by repeating
+the same block of compressed zeroes (about 16 KB, decompressing to 16 MB), so
+the client has to keep decompressing as long as it stays connected. Compressed
+with gzip by default, set `compression_type` to `deflate` to change it. The
+default rate limit is 1024 bytes per second.
+
+#### http_nested_deflate_bomb
+
+Sends a deflate bomb compressed a second time, with stacked encodings like
+`Content-Encoding: deflate, gzip`. About 26 KB on the wire decompresses to
+about 16 GB, so far beyond the 1030:1 limit of a single layer. Set
+`compression_type` to a comma separated list of `gzip` and `deflate`, in the
+order they are applied, to change it. Only clients which decode every listed
+encoding are affected, like curl with `--compressed`. The default rate limit
+is 16 bytes per second.
+
 ### SSH
 
 #### endlessh
@@ -227,6 +265,51 @@ tarpitd.conf - configuration file of tarpitd
 
 It is a TOML format file.
 
+## Top-level Keys
+
+#### `workers=` (int)
+
+Number of worker processes. Default is `1`.
+
+When larger than 1, tarpitd.py forks this many processes, and every one of
+them binds all `bind` entries with `SO_REUSEPORT`. The kernel spreads accepted
+connections across the workers. The parent process supervises the workers and
+restarts any worker that dies. Only available on Unix-like systems.
+
+#### `content_cache=` (str)
+
+Path to a directory for caching generated content. Disabled by default.
+
+Patterns like `http_deflate_size_bomb` compress a large amount of data at
+startup. With this option, the result is saved in this directory, keyed by the
+pattern and the parameters that affect the output, and is reused on the next
+start. Random content, like the page of `http_bad_site`, is not saved. Cached
+content is memory-mapped, so tarpits and worker processes serving the same
+content share memory.
+
+Content which is not cached is generated in a pool of processes at startup,
+once for all tarpits with the same pattern and parameters. Tarpits start
+listening as soon as their own content is ready, and the others do not wait
+for it. With several `workers`, the workers are forked once all content is
+ready. An invalid parameter like an unknown `compression_type` stops tarpitd
+at startup, and a tarpit whose content fails to generate is logged and does
+not listen, while the others keep running.
+
+With or without this option, tarpits with the same pattern and parameters
+share one copy of their content in memory.
+
+#### `bandwidth=` (float)
+
+Total bandwidth in bytes per second for all tarpits of this program. Disabled
+by default.
+
+With more than one worker, every worker gets an equal share.
+
+#### `bandwidth_burst=` (float)
+
+Size in bytes of the burst allowed by `bandwidth`. Default is one second of
+`bandwidth`.
+
 ## `[tarpits.<name>]` Table
 
 #### `<name>`
@@ -249,16 +332,206 @@ A list of addresses and ports to listen on.
 Every item in this list should contain `host` and `port` values; see the
 example below.
 
-#### `rate_limit=` (int)
+#### `rate_limit=` (int or float)
+
+Sets the data transfer rate limit of each connection.
 
-Sets the data transfer rate limit.
+Follows the same rule as [tarpit.py(1)](./tarpitd.py.1.md). Fractional values
+are accepted, e.g. `0.5` sends one byte every 2 seconds.
 
-Follows the same rule as [tarpit.py(1)](./tarpitd.py.1.md).
+#### `bandwidth=` (float)
+
+Total bandwidth in bytes per second shared by all connections of this tarpit.
+Disabled by default.
+
+Every connection takes its data from a token bucket of its own (set by
+`rate_limit`), which is nested in the bucket of the tarpit, which is nested in
+the process-wide bucket (see `bandwidth` in the top-level keys). A connection
+may only send when all of these buckets allow it. The bandwidth is split
+fairly between connections, so thousands of trapped clients can share a small
+amount of bandwidth without tuning `rate_limit`.
+
+#### `bandwidth_burst=` (float)
+
+Size in bytes of the burst allowed by `bandwidth`. Default is one second of
+`bandwidth`.
+
+#### `pacing=` (str)
+
+Selects how rate limited data is paced.
+
+Accept: `userspace`, `wheel`, `kernel`. Default is `userspace`.
+
+`userspace` lets every connection sleep between its own writes. `wheel`
+registers connections on one shared timer wheel per process, which emits the
+next chunk for every due connection in one pass. This keeps the timer queue of
+the event loop small when tens of thousands of clients are trapped. The wheel
+ticks every 0.1 seconds.
+
+`kernel` works only with a positive `rate_limit` on Linux. It sets the
+`SO_MAX_PACING_RATE` socket option and hands whole buffers to the kernel, so
+the program does not need to wake up every second. The kernel enforces the
+limit with the fq qdisc or with TCP internal pacing (Linux 4.13 and later). If
+the option is rejected, or the rate limit is negative, `userspace` pacing is
+used.
+
+#### `backend=` (str)
+
+Selects the connection core.
+
+Accept: `stream`, `protocol`. Default is `stream`.
+
+`stream` uses the asyncio stream API, which creates a reader with its own
+buffer, a writer and some helper objects for every client. `protocol` keeps
+the state of each connection in one small object built on asyncio.Protocol,
+with a bounded 1 KiB receive buffer, and avoids creating extra tasks for
+patterns that never read from the client. It uses much less memory per trapped
+client.
+
+Patterns which send the same data whatever the client sends are served by
+`protocol` without any task: validation, pacing and accounting are run from
+timers and transport callbacks, and only the first 1 KiB sent by the client is
+read. This applies with an integer `rate_limit`, `userspace` or `wheel` pacing
+and no `bandwidth` limit. Other settings, and patterns reading the request
+(such as `keep_alive`), use one task per client.
 
 #### `max_clients=` (int)
 
-The maximum number of clients the server will handle. This is calculated per
-bind port.
+The maximum number of clients the server will handle. This is shared by all
+bind ports of this tarpit.
+
+With more than one worker, every worker handles up to `max_clients / workers`
+clients, so the value keeps its meaning for the whole program.
+
+#### `admission=` (str)
+
+What to do with a new client when `max_clients` is reached.
+
+Accept: `queue`, `pause`, `reject`, `evict_oldest`, `evict_idle`. Default is
+`queue`.
+
+* `queue`: the client waits for a free slot, in a queue of `max_queue` clients.
+* `pause`: stop accepting connections until a slot is free, so new clients wait in the kernel backlog instead. Clients that were already accepted are queued as with `queue`. Needs the default selector event loop of asyncio, the tarpit fails to start on other event loops.
+* `reject`: close the connection right away.
+* `evict_oldest`: close the client that has been trapped the longest, and serve the new one.
+* `evict_idle`: close the client that received data least recently, and serve the new one.
+
+Clients that are rejected because the queue is full, or because of `reject`,
+are logged with the `reject` event in the client trace.
+
+#### `max_queue=` (int)
+
+The maximum number of clients waiting for a free slot. Clients beyond it are
+rejected. Default is `1024`.
+
+#### `max_clients_per_ip=` (int)
+
+The maximum number of connections from one source address. Disabled by
+default.
+
+#### `max_clients_per_prefix=` (int)
+
+The maximum number of connections from one source network, whose size is set
+by `prefix_v4` and `prefix_v6`. Disabled by default.
+
+The counts are kept in a fixed-size probabilistic table, so memory use does
+not grow with the number of sources. Rarely, a source may be limited a bit
+early because it shares counters with another source. A limit is never
+exceeded.
+
+#### `prefix_v4=` (int)
+
+Prefix length of an IPv4 source network. Default is `24`.
+
+#### `prefix_v6=` (int)
+
+Prefix length of an IPv6 source network. Default is `64`.
+
+#### `over_limit=` (str)
+
+What to do with a connection over `max_clients_per_ip` or
+`max_clients_per_prefix`.
+
+Accept: `close`, `hold`. Default is `close`.
+
+`hold` keeps the connection open without sending anything, until the client
+leaves. Held connections do not take a slot of `max_clients`. Both are logged
+with the `reject` event in the client trace.
+
+#### `tcp_user_timeout=` (int)
+
+Sets `TCP_USER_TIMEOUT` on accepted connections, in milliseconds. Disabled by
+default (the system default is used). Linux only.
+
+When a client vanishes without closing the connection, the kernel keeps
+retransmitting data for about 15 minutes by default, and the connection keeps
+its slot all this time. With this option, the connection is dropped when sent
+data stays unacknowledged for the given time. Since tarpits send very slowly,
+choose a value a few times larger than the interval between two writes.
+
+#### `keepalive=` (bool)
+
+Enables TCP keepalive (`SO_KEEPALIVE`) on accepted connections. Default is
+`false`.
+
+Useful when a tarpit waits for a long time without sending anything.
+
+#### `keepidle=`, `keepintvl=`, `keepcnt=` (int)
+
+Set `TCP_KEEPIDLE`, `TCP_KEEPINTVL` (both in seconds) and `TCP_KEEPCNT` on
+accepted connections. The system defaults are used if not set.
+
+Connections reclaimed by these options are logged with the `conn_error` event
+(`TimeoutError`) in the client trace, and counted per tarpit.
+
+#### `stall_timeout=` (float)
+
+Seconds a client may stop reading before its connection is parked. Disabled
+(`0`) by default.
+
+When the client stops reading, writes wait in a parking lot shared by all
+connections, which is checked once per second. After `stall_timeout` seconds,
+the kernel send buffer of the connection is shrunk, so it does not hold more
+memory than needed. The connection continues when the client has read
+everything that was sent.
+
+Connections served without a task (see `backend`) hold no task while parked.
+The data already written to the connection stays buffered until the client
+reads it, as dropping it would corrupt the stream.
+
+#### `analytics=` (bool)
+
+Keep live statistics about the sources of this tarpit, in fixed memory: an
+estimate of the number of distinct source addresses (HyperLogLog), and the
+sources which held connections the longest (Space-Saving). Default is `false`.
+
+The statistics are exposed in `[metrics]` as `tarpitd_unique_sources` and
+`tarpitd_top_source_seconds`, and written to the main log every
+`analytics_interval` seconds.
+
+#### `analytics_top=` (int)
+
+Number of sources tracked for the top list. Sources taking more than
+1/`analytics_top` of the total time are always in the list. Default is `64`.
+
+#### `analytics_interval=` (float)
+
+Interval in seconds of the summary in the main log. Default is `300`.
+
+#### `keep_alive=` (bool)
+
+HTTP patterns only. Read every request, and keep serving HTTP/1.1 clients on
+the same connection, one slow response per request, including pipelined ones.
+Default is `false`, which sends one response and closes the connection.
+
+Requests with a body or `Connection: close`, HTTP/1.0 requests, and `HEAD`
+requests, which still get a body, end the connection after their response. At
+most 8 KB of request head is read at a time.
+
+#### `max_requests=` (int)
+
+HTTP patterns only. Maximum number of requests served on one connection with
+`keep_alive`, at least `1`. Default is `64`.
 
 #### `client_validation=` (bool)
 
@@ -269,6 +542,10 @@ Validate the client before sending a response.
 Enable logging of client access. Client validation result is logged with
 access log.
 
+The `close` event reports what the connection cost: the captured request,
+`bytes_sent`, the number of `writes`, `drain_time` (seconds spent waiting for
+the client to take data) and `duration` (seconds the connection was held).
+
 ## `[logging]` Table
 
 #### `main=` (str)
@@ -291,6 +568,61 @@ supported.
 
 Default is `<stdout>`.
 
+Client trace events are written by a background thread, in batches. Events
+wait in a bounded queue until they are written.
+
+#### `client_trace_format=` (str)
+
+Format of the client trace log.
+
+Accept: `jsonl` (one JSON object per line), `binary` (compact length-prefixed
+records, with raw request bytes and packed addresses). Default is `jsonl`.
+
+Use `tarpitd.py --convert-trace FILE` to convert a binary trace to jsonl.
+
+#### `client_trace_queue=` (int)
+
+Size of the client trace queue, in events. Default is `65536`.
+
+#### `client_trace_overflow=` (str)
+
+What to do when the client trace queue is full.
+
+Accept: `drop` (drop new events), `sample` (once the queue is half full, keep
+one of every `client_trace_sample` events), `block` (wait for the queue; no
+event is lost, but all connections stall). Default is `drop`.
+
+#### `client_trace_sample=` (int)
+
+See `client_trace_overflow`. Default is `16`.
+
+#### `client_trace_report=` (float)
+
+Interval in seconds for reporting the number of dropped events to the main
+log. `0` disables the reports, except one at shutdown. Default is `60`.
+
+## `[metrics]` Table
+
+Optional. Serves counters and gauges of every tarpit in the Prometheus text
+format, at `http://HOST:PORT/metrics`. Every metric has the labels `name` and
+`pattern`.
+
+Exposed metrics: `tarpitd_connections`, `tarpitd_waiters`, `tarpitd_parked`,
+`tarpitd_accepted_total`, `tarpitd_rejected_total` (by `reason`),
+`tarpitd_sent_bytes_total`, `tarpitd_validations_total` (by `result`),
+`tarpitd_connection_errors_total` (by `error`),
+`tarpitd_dead_peers_reclaimed_total`, `tarpitd_parked_total` and the histogram
+`tarpitd_connection_duration_seconds`.
+
+#### `bind=` (array of tables)
+
+Addresses to serve metrics on, in the same form as the `bind` of a tarpit.
+With several `workers`, every worker has its own counters, and worker N
+listens on `port + N`.
+
+  [metrics]
+  bind = [{ host = "127.0.0.1", port = 9464 }]
+
 ## Example
 
   [tarpits]
@@ -348,6 +680,27 @@ import dataclasses
 import time
 import typing
 import copy
+import collections
+import array
+import errno
+import weakref
+import socket
+import selectors
+import os
+import math
+import hashlib
+import mmap
+import queue
+import struct
+import bisect
+import threading
+import concurrent.futures
+import multiprocessing
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # module for cli use only will be import when needed
 
@@ -361,6 +714,721 @@ class BytesLiteralEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# Not exported by the socket module, see asm-generic/socket.h
+SO_MAX_PACING_RATE: int = getattr(socket, "SO_MAX_PACING_RATE", 47)
+# Unsent bytes in the send queue: ioctl on Linux, socket option on macOS
+SIOCOUTQ: int = 0x5411
+SO_NWRITE: int = 0x1024
+
+
+class TokenBucket:
+    """
+    A token bucket refilled with "rate" tokens (bytes) per second, holding
+    up to "burst" tokens. Buckets can be nested: taking tokens from a
+    bucket also takes them from all of its parents.
+
+    Takers may go into debt, and then wait until the debt is paid back.
+    Every taker waits for the debt of all takers before it, so a shared
+    bucket is split fairly between connections without any tuning.
+    """
+
+    __slots__ = ("rate", "burst", "parent", "_tokens", "_stamp")
+
+    # The process-wide bucket, parent of all tarpit buckets
+    process_wide: "TokenBucket | None" = None
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 0,
+        parent: "TokenBucket | None" = None,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.parent = parent
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def take(self, n: int) -> float:
+        """
+        Take n tokens from this bucket and all its parents.
+
+        Returns the time in seconds to wait before sending.
+        """
+        now = time.monotonic()
+        delay = 0.0
+        bucket: TokenBucket | None = self
+        while bucket is not None:
+            tokens = bucket._tokens + (now - bucket._stamp) * bucket.rate
+            if tokens > bucket.burst:
+                tokens = bucket.burst
+            tokens -= n
+            bucket._tokens = tokens
+            bucket._stamp = now
+            if tokens < 0 and -tokens / bucket.rate > delay:
+                delay = -tokens / bucket.rate
+            bucket = bucket.parent
+        return delay
+
+
+class PacingWheel:
+    """
+    A bucketed timer wheel shared by all paced connections of an event loop.
+
+    Instead of one asyncio.sleep() per connection (and one entry per
+    connection in the timer heap of the event loop), paced writes are
+    registered here as jobs. A single timer fires every TICK seconds and
+    writes the next chunk of every due job in one pass. Delays longer than
+    one turn of the wheel are counted down in rounds.
+    """
+
+    TICK: float = 0.1
+    SLOTS: int = 1024
+
+    class Job:
+        __slots__ = (
+            "transport",
+            "data",
+            "pos",
+            "step",
+            "interval",
+            "rounds",
+            "future",
+        )
+
+        def __init__(self, transport, data, step, interval, future) -> None:
+            self.transport = transport
+            self.data = data
+            self.pos = 0
+            self.step = step
+            self.interval = interval
+            self.rounds = 0
+            self.future = future
+
+    _wheels: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get(cls) -> "PacingWheel":
+        """
+        Return the wheel of the running event loop, create it if needed.
+        """
+        loop = asyncio.get_running_loop()
+        wheel = cls._wheels.get(loop)
+        if wheel is None:
+            wheel = cls(loop)
+            cls._wheels[loop] = wheel
+        return wheel
+
+    def submit(self, transport, data, step: int, interval: float):
+        """
+        Write data to transport, step bytes every interval seconds.
+
+        Returns a future which is done when all data has been handed to the
+        transport. Cancel the future to drop the job.
+        """
+        future = self._loop.create_future()
+        self._schedule(self.Job(transport, data, step, interval, future))
+        return future
+
+    def sleep(self, delay: float):
+        """
+        Returns a future which is done after delay seconds, rounded to
+        the tick of the wheel.
+        """
+        future = self._loop.create_future()
+        self._schedule(self.Job(None, b"", 0, delay, future))
+        return future
+
+    def _schedule(self, job: Job):
+        ticks = max(1, round(job.interval / self.TICK))
+        job.rounds, offset = divmod(ticks - 1, self.SLOTS)
+        self._slots[(self._cursor + 1 + offset) % self.SLOTS].append(job)
+        self._count += 1
+        # While running, _run() arms the timer itself when it is done
+        if self._handle is None and not self._running:
+            self._next_at = self._loop.time() + self.TICK
+            self._handle = self._loop.call_at(self._next_at, self._run)
+
+    def _run(self):
+        self._handle = None
+        self._running = True
+        try:
+            now = self._loop.time()
+            # Catch up if the event loop was late for more than one tick
+            while self._next_at <= now and self._count:
+                self._cursor = (self._cursor + 1) % self.SLOTS
+                due = self._slots[self._cursor]
+                self._slots[self._cursor] = []
+                for job in due:
+                    if job.rounds:
+                        job.rounds -= 1
+                        self._slots[self._cursor].append(job)
+                        continue
+                    self._count -= 1
+                    self._step(job)
+                self._next_at += self.TICK
+        finally:
+            self._running = False
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._count:
+            self._handle = self._loop.call_at(self._next_at, self._run)
+
+    def _step(self, job: Job):
+        future = job.future
+        if future.done():  # cancelled by the writer
+            return
+        transport = job.transport
+        if transport is None:  # sleep()
+            future.set_result(None)
+            return
+        if transport.is_closing():
+            future.set_exception(ConnectionResetError("Connection lost"))
+            return
+        if transport.get_write_buffer_size():
+            # The client is not reading, try again next time
+            self._schedule(job)
+            return
+        end = job.pos + job.step
+        try:
+            transport.write(job.data[job.pos : end])
+        except Exception as e:
+            future.set_exception(e)
+            return
+        job.pos = end
+        if end >= len(job.data):
+            future.set_result(None)
+        else:
+            self._schedule(job)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._slots: list[list[PacingWheel.Job]] = [
+            [] for _ in range(self.SLOTS)
+        ]
+        self._cursor = 0
+        self._count = 0
+        self._next_at = 0.0
+        self._handle: asyncio.TimerHandle | None = None
+        self._running = False
+
+
+def unsent_bytes(sock) -> int | None:
+    """
+    Returns the number of bytes in the kernel send queue of sock which
+    the peer has not acknowledged, or None if it can not be queried.
+    """
+    try:
+        if sys.platform.startswith("linux") and fcntl is not None:
+            buf = fcntl.ioctl(sock.fileno(), SIOCOUTQ, b"\0" * 4)
+            return int.from_bytes(buf, sys.byteorder)
+        if sys.platform == "darwin":
+            return sock.getsockopt(socket.SOL_SOCKET, SO_NWRITE)
+    except OSError:
+        pass
+    return None
+
+
+class ParkingLot:
+    """
+    Holds the connections of an event loop whose client stopped reading.
+
+    A write which does not fit in the transport buffer waits here instead
+    of in StreamWriter.drain(), on a future without any timer. A single
+    sweep runs every SWEEP seconds over all waiting connections: the ones
+    which can take data again are resumed, the ones stalled for longer
+    than their stall_timeout are parked.
+
+    Parking shrinks the kernel send buffer and the limits of the transport
+    buffer, so the stuck client does not make us hold more memory. A
+    parked connection is only resumed when the transport buffer is empty
+    and the kernel send queue (SIOCOUTQ) has drained below PARKED_SNDBUF.
+    """
+
+    SWEEP: float = 1.0
+    PARKED_SNDBUF: int = 4096
+
+    class Entry:
+        __slots__ = (
+            "transport",
+            "future",
+            "since",
+            "timeout",
+            "stats",
+            "limits",
+        )
+
+        def __init__(self, transport, future, since, timeout, stats) -> None:
+            self.transport = transport
+            self.future = future
+            self.since = since
+            self.timeout = timeout
+            self.stats = stats
+            self.limits: tuple[int, int] | None = None  # Set when parked
+
+    _lots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get(cls) -> "ParkingLot":
+        """
+        Return the parking lot of the running event loop, create it if
+        needed.
+        """
+        loop = asyncio.get_running_loop()
+        lot = cls._lots.get(loop)
+        if lot is None:
+            lot = cls(loop)
+            cls._lots[loop] = lot
+        return lot
+
+    def wait(self, transport, timeout: float, stats: "TarpitStats"):
+        """
+        Returns a future which is done when transport can take data again.
+        Park the connection if it is still stalled after timeout seconds.
+        """
+        future = self._loop.create_future()
+        entry = self.Entry(
+            transport, future, self._loop.time(), timeout, stats
+        )
+        self._entries.append(entry)
+        if self._handle is None:
+            self._handle = self._loop.call_later(self.SWEEP, self._sweep)
+        return future
+
+    def _park(self, entry: Entry):
+        transport = entry.transport
+        entry.limits = transport.get_write_buffer_limits()[::-1]
+        # Resume only after the buffer has been emptied
+        transport.set_write_buffer_limits(high=self.PARKED_SNDBUF, low=0)
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            try:
+                sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_SNDBUF, self.PARKED_SNDBUF
+                )
+            except OSError:
+                pass
+        entry.stats.parked += 1
+        entry.stats.parked_total += 1
+
+    def _unpark(self, entry: Entry):
+        if entry.limits is None:
+            return
+        entry.stats.parked -= 1
+        if not entry.transport.is_closing():
+            high, low = entry.limits
+            entry.transport.set_write_buffer_limits(high=high, low=low)
+
+    def _writable(self, entry: Entry) -> bool:
+        transport = entry.transport
+        size = transport.get_write_buffer_size()
+        if entry.limits is None:
+            return size <= transport.get_write_buffer_limits()[0]
+        if size:
+            return False
+        sock = transport.get_extra_info("socket")
+        unsent = unsent_bytes(sock) if sock is not None else None
+        return unsent is None or unsent <= self.PARKED_SNDBUF
+
+    def _sweep(self):
+        self._handle = None
+        now = self._loop.time()
+        waiting = []
+        for entry in self._entries:
+            future = entry.future
+            if future.done():  # cancelled by the writer
+                self._unpark(entry)
+            elif entry.transport.is_closing():
+                self._unpark(entry)
+                future.set_exception(ConnectionResetError("Connection lost"))
+            elif self._writable(entry):
+                self._unpark(entry)
+                future.set_result(None)
+            else:
+                if entry.limits is None and now - entry.since >= entry.timeout:
+                    self._park(entry)
+                waiting.append(entry)
+        self._entries = waiting
+        if waiting:
+            self._handle = self._loop.call_later(self.SWEEP, self._sweep)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._entries: list[ParkingLot.Entry] = []
+        self._handle: asyncio.TimerHandle | None = None
+
+
+def pack_address(peername) -> bytes | None:
+    """
+    Returns the packed IP address of peername, with IPv4-mapped IPv6
+    addresses turned into IPv4, or None if it is not an IP socket.
+    """
+    try:
+        host = peername[0]
+        if ":" in host:
+            packed = socket.inet_pton(socket.AF_INET6, host.split("%")[0])
+            if packed.startswith(b"\x00" * 10 + b"\xff\xff"):
+                packed = packed[12:]  # IPv4-mapped address
+        else:
+            packed = socket.inet_aton(host)
+    except (TypeError, IndexError, OSError):
+        return None
+    return packed
+
+
+def unpack_address(packed: bytes) -> str:
+    family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, packed)
+
+
+class SpaceSaving:
+    """
+    Finds the keys with the largest total weight in a stream, keeping at
+    most "size" counters (the Space-Saving algorithm).
+
+    When a new key arrives and all counters are in use, the smallest
+    counter is taken over by the new key, which inherits its weight. A
+    reported weight may be over-estimated by at most its error, but any
+    key heavier than 1/size of the total is always kept.
+    """
+
+    def __init__(self, size: int = 64) -> None:
+        self.size = max(1, size)
+        # A min-heap of [weight, error, key] by weight, so the smallest
+        # counter is found in O(1) and updated in O(log size), and the
+        # position of every key in it
+        self._heap: list[list] = []
+        self._index: dict[bytes, int] = {}
+
+    def add(self, key: bytes, weight: float = 1):
+        heap = self._heap
+        pos = self._index.get(key)
+        if pos is not None:
+            heap[pos][0] += weight
+        elif len(heap) < self.size:
+            pos = len(heap)
+            heap.append([weight, 0, key])
+            self._index[key] = pos
+            self._sift_up(pos)
+            return
+        else:
+            pos = 0
+            counter = heap[0]
+            del self._index[counter[2]]
+            least = counter[0]
+            counter[:] = least + weight, least, key
+            self._index[key] = 0
+        # Weights only grow, so the counter can only go down the heap
+        self._sift_down(pos)
+
+    def _sift_up(self, pos: int):
+        heap, index = self._heap, self._index
+        counter = heap[pos]
+        while pos:
+            parent = (pos - 1) >> 1
+            if heap[parent][0] <= counter[0]:
+                break
+            heap[pos] = heap[parent]
+            index[heap[pos][2]] = pos
+            pos = parent
+        heap[pos] = counter
+        index[counter[2]] = pos
+
+    def _sift_down(self, pos: int):
+        heap, index = self._heap, self._index
+        counter = heap[pos]
+        end = len(heap)
+        while True:
+            child = 2 * pos + 1
+            if child >= end:
+                break
+            if child + 1 < end and heap[child + 1][0] < heap[child][0]:
+                child += 1
+            if counter[0] <= heap[child][0]:
+                break
+            heap[pos] = heap[child]
+            index[heap[pos][2]] = pos
+            pos = child
+        heap[pos] = counter
+        index[counter[2]] = pos
+
+    def top(self, n: int) -> list[tuple[bytes, float, float]]:
+        """
+        Returns up to n (key, weight, error), heaviest first.
+        """
+        items = sorted(self._heap, key=lambda c: c[0], reverse=True)
+        return [(c[2], c[0], c[1]) for c in items[:n]]
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct keys in a stream, in 2**P bytes.
+    The standard error is about 1.04 / sqrt(2**P), 1.6% with P = 12.
+    """
+
+    P: int = 12
+
+    def __init__(self) -> None:
+        self._registers = bytearray(1 << self.P)
+
+    def add(self, key: bytes):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        index = h >> (64 - self.P)
+        rest = h & ((1 << (64 - self.P)) - 1)
+        rank = 64 - self.P - rest.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def count(self) -> int:
+        m = len(self._registers)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / (
+            math.fsum(2.0**-r for r in self._registers)
+        )
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Linear counting
+        return round(estimate)
+
+
+class SourceLimiter:
+    """
+    Limits open connections per source address and per source prefix.
+
+    Counts are kept in a count-min sketch: every key is hashed to one
+    counter in each of two rows, with a separately salted hash per row,
+    and its count is the smaller one. Memory
+    is fixed no matter how many sources there are, and every operation is
+    O(1). Hash collisions can only over-estimate a count, so a limit is
+    never exceeded, but a few innocent sources may be limited early.
+    """
+
+    WIDTH: int = 1 << 16
+
+    def __init__(
+        self,
+        per_ip: int = 0,
+        per_prefix: int = 0,
+        prefix_v4: int = 24,
+        prefix_v6: int = 64,
+    ) -> None:
+        self.per_ip = per_ip
+        self.per_prefix = per_prefix
+        self._masks = {
+            4: (0xFFFFFFFF << (32 - prefix_v4)) & 0xFFFFFFFF,
+            16: ((1 << 128) - 1) ^ ((1 << (128 - prefix_v6)) - 1),
+        }
+        self._rows = (
+            array.array("I", bytes(4 * self.WIDTH)),
+            array.array("I", bytes(4 * self.WIDTH)),
+        )
+        # Randomly salted, so nobody can pick sources which collide on
+        # purpose. Copied for every key, cheaper than a new hash.
+        self._hashes = (
+            hashlib.blake2b(digest_size=4, salt=os.urandom(16)),
+            hashlib.blake2b(digest_size=4, salt=os.urandom(16)),
+        )
+
+    def keys(self, peername) -> tuple[bytes, bytes] | None:
+        """
+        Returns the keys of the address and of its prefix.
+        """
+        packed = pack_address(peername)
+        if packed is None:
+            return None  # Not an IP socket
+        length = len(packed)
+        prefix = int.from_bytes(packed, "big") & self._masks[length]
+        # The last byte tells the prefix key apart from the address key
+        return packed, prefix.to_bytes(length, "big") + b"/"
+
+    def _indexes(self, key: bytes) -> tuple[int, int]:
+        mask = self.WIDTH - 1
+        h0, h1 = self._hashes[0].copy(), self._hashes[1].copy()
+        h0.update(key)
+        h1.update(key)
+        return (
+            int.from_bytes(h0.digest()) & mask,
+            int.from_bytes(h1.digest()) & mask,
+        )
+
+    def _count(self, indexes: tuple[int, int], delta: int) -> int:
+        i, j = indexes
+        row0, row1 = self._rows
+        row0[i] += delta
+        row1[j] += delta
+        return min(row0[i], row1[j])
+
+    def _estimate(self, indexes: tuple[int, int]) -> int:
+        i, j = indexes
+        return min(self._rows[0][i], self._rows[1][j])
+
+    def acquire(self, keys: tuple[bytes, bytes]) -> str | None:
+        """
+        Count a new connection from the source.
+
+        Returns the reason if the source is over a limit, and then the
+        connection is not counted.
+        """
+        ip, prefix = self._indexes(keys[0]), self._indexes(keys[1])
+        if self.per_ip and self._estimate(ip) >= self.per_ip:
+            return "per_ip"
+        if self.per_prefix and self._estimate(prefix) >= self.per_prefix:
+            return "per_prefix"
+        self._count(ip, 1)
+        self._count(prefix, 1)
+        return None
+
+    def release(self, keys: tuple[bytes, bytes]):
+        self._count(self._indexes(keys[0]), -1)
+        self._count(self._indexes(keys[1]), -1)
+
+
+class TarpitStats:
+    """
+    Counters of a tarpit, updated with plain integer increments.
+    """
+
+    # Upper bounds of the connection duration histogram, in seconds
+    DURATION_BUCKETS: tuple[float, ...] = (
+        1, 10, 60, 300, 900, 3600, 14400, 86400,
+    )
+    CONN_ERRORS: tuple[str, ...] = (
+        "BrokenPipeError",
+        "ConnectionAbortedError",
+        "ConnectionResetError",
+        "TimeoutError",
+        "other",
+    )
+    REJECT_REASONS: tuple[str, ...] = ("max_clients", "per_ip", "per_prefix")
+
+    __slots__ = (
+        "dead_peer_reclaimed",
+        "parked",
+        "parked_total",
+        "accepted",
+        "rejected",
+        "bytes_sent",
+        "validation_passed",
+        "validation_failed",
+        "conn_errors",
+        "duration_buckets",
+        "duration_sum",
+    )
+
+    def __init__(self) -> None:
+        # Connections closed by TCP_USER_TIMEOUT or keepalive
+        self.dead_peer_reclaimed = 0
+        # Connections in the ParkingLot, now and since start
+        self.parked = 0
+        self.parked_total = 0
+        self.accepted = 0
+        self.rejected = dict.fromkeys(self.REJECT_REASONS, 0)
+        self.bytes_sent = 0
+        self.validation_passed = 0
+        self.validation_failed = 0
+        self.conn_errors = dict.fromkeys(self.CONN_ERRORS, 0)
+        # Not cumulative, the last one counts everything longer
+        self.duration_buckets = [0] * (len(self.DURATION_BUCKETS) + 1)
+        self.duration_sum = 0.0
+
+    def observe_duration(self, seconds: float):
+        index = bisect.bisect_left(self.DURATION_BUCKETS, seconds)
+        self.duration_buckets[index] += 1
+        self.duration_sum += seconds
+
+
+class ClientRecord:
+    """
+    Bookkeeping of an admitted client, used by admission control, and
+    accounting of what the connection cost us, updated by TarpitWriter.
+    """
+
+    __slots__ = (
+        "task",
+        "opened",
+        "last_active",
+        "bytes_sent",
+        "writes",
+        "drain_time",
+    )
+
+    def __init__(self, task: "asyncio.Task | StaticProtocol | None") -> None:
+        # Cancelled to evict the client
+        self.task = task
+        self.opened = self.last_active = time.monotonic()
+        self.bytes_sent = 0
+        self.writes = 0
+        # Seconds spent waiting for the client to take the data
+        self.drain_time = 0.0
+
+    def accounting(self) -> dict:
+        return {
+            "bytes_sent": self.bytes_sent,
+            "writes": self.writes,
+            "drain_time": round(self.drain_time, 3),
+            "duration": round(time.monotonic() - self.opened, 3),
+        }
+
+
+class StaticBuffer:
+    """
+    Payloads which are sent again and again, registered once per process.
+
+    On Linux every payload is also copied into a memfd, so
+    TarpitWriter.send_static() can hand it to the kernel with sendfile(),
+    and no data passes through Python. Payloads which are already in a
+    file (mapped from the ContentCache) are sent from that file instead.
+    Register payloads in _setup, so forked workers inherit the file
+    instead of making their own copy.
+    """
+
+    _buffers: dict[
+        int, tuple[memoryview, typing.BinaryIO | None, int]
+    ] = {}
+    _next_id: int = 0
+
+    @classmethod
+    def register(
+        cls, data, file: typing.BinaryIO | None = None, offset: int = 0
+    ) -> int:
+        """
+        Returns the id of the buffer, to be used with send_static().
+
+        If file is given, data is the same as its content from offset, and
+        the buffer takes ownership of it.
+        """
+        view = memoryview(data).cast("B")
+        if file is None and hasattr(os, "memfd_create"):
+            try:
+                fd = os.memfd_create("tarpitd")
+                file = open(fd, "r+b", buffering=0)
+                written = 0
+                while written < len(view):
+                    written += file.write(view[written:])
+            except OSError as e:
+                logging.debug("memfd is not available: %s", e)
+                file = None
+        buffer_id = cls._next_id
+        cls._next_id += 1
+        cls._buffers[buffer_id] = (view, file, offset)
+        return buffer_id
+
+    @classmethod
+    def get(
+        cls, buffer_id: int
+    ) -> tuple[memoryview, typing.BinaryIO | None, int]:
+        """
+        Returns the data, and the file holding it with its offset there.
+        """
+        return cls._buffers[buffer_id]
+
+    @classmethod
+    def release(cls, buffer_id: int) -> None:
+        _, file, _ = cls._buffers.pop(buffer_id)
+        if file is not None:
+            file.close()
+
+
 class TarpitWriter:
     """
     A wrapper around asyncio.StreamWriter that adds configurable speed limiting to data transmission.
@@ -373,8 +1441,7 @@ class TarpitWriter:
         for b in range(0, len(data)):
             await asyncio.sleep(abs(self.rate))
             try:  # Handle Exception, because we are in loop
-                self.__writer.write(data[b : b + 1])
-                await self.__writer.drain()
+                await self._write_normal(data[b : b + 1])
             except (ConnectionResetError, BrokenPipeError) as e:
                 raise e
                 return
@@ -382,7 +1449,22 @@ class TarpitWriter:
 
     async def _write_normal(self, data):
         self.__writer.write(data)
+        record = self.record
+        record.bytes_sent += len(data)
+        record.writes += 1
+        self.stats.bytes_sent += len(data)
+        started = time.monotonic()
+        if self.stall_timeout:
+            transport = self.__writer.transport
+            size = transport.get_write_buffer_size()
+            if size > transport.get_write_buffer_limits()[1]:
+                # The client may have stopped reading, wait in the lot
+                await ParkingLot.get().wait(
+                    transport, self.stall_timeout, self.stats
+                )
         await self.__writer.drain()
+        record.last_active = time.monotonic()
+        record.drain_time += record.last_active - started
 
     async def _write_with_speedlimit(self, data):
         """
@@ -394,19 +1476,161 @@ class TarpitWriter:
         for b in range(0, count):
             await asyncio.sleep(1)
             try:
-                self.__writer.write(data[b * self.rate : (b + 1) * self.rate])
-                await self.__writer.drain()
+                await self._write_normal(
+                    data[b * self.rate : (b + 1) * self.rate]
+                )
             except (ConnectionResetError, BrokenPipeError) as e:
                 raise e
                 return
-        self.__writer.write(data[(count) * self.rate :])
+        await self._write_normal(data[(count) * self.rate :])
+
+    async def _write_with_bucket(self, data):
+        """
+        Send data in chunks, each chunk waits for tokens from the bucket
+        of this connection and its parents (tarpit and process-wide).
+        """
+        bucket = self._bucket
+        assert bucket is not None
+        step = self._bucket_step
+        for b in range(0, len(data), step):
+            chunk = data[b : b + step]
+            delay = bucket.take(len(chunk))
+            if delay:
+                if self.pacing == "wheel":
+                    await PacingWheel.get().sleep(delay)
+                else:
+                    await asyncio.sleep(delay)
+            await self._write_normal(chunk)
+
+    async def _write_with_wheel(self, data):
+        """
+        Hand data to the shared PacingWheel, so no timer is created for
+        this connection. Used when pacing is "wheel".
+        """
+        if self.rate < 0:
+            step, interval = 1, abs(self.rate)
+        else:
+            step, interval = self.rate, 1
+        await PacingWheel.get().submit(
+            self.__writer.transport, data, step, interval
+        )
+        record = self.record
+        record.bytes_sent += len(data)
+        record.writes += -(-len(data) // step)
+        self.stats.bytes_sent += len(data)
+        started = time.monotonic()
         await self.__writer.drain()
+        record.last_active = time.monotonic()
+        record.drain_time += record.last_active - started
+
+    async def send_static(
+        self, buffer_id: int, offset: int = 0, length: int | None = None
+    ):
+        """
+        Send "length" bytes from "offset" of a StaticBuffer, the rest of
+        it by default.
+
+        When the data goes to the kernel as a whole (rate limit 0, or
+        kernel pacing) and the buffer is backed by a file, it is sent with
+        loop.sendfile(), without being copied through Python. Otherwise
+        it is written with write_and_drain().
+        """
+        view, file, base = StaticBuffer.get(buffer_id)
+        if length is None:
+            length = len(view) - offset
+        if (
+            file is not None
+            and self._sendfile
+            and self.write_and_drain == self._write_normal
+        ):
+            started = time.monotonic()
+            transport = self.__writer.transport
+            try:
+                await asyncio.get_running_loop().sendfile(
+                    transport,
+                    file,
+                    base + offset,
+                    length,
+                    fallback=False,
+                )
+            except asyncio.SendfileNotAvailableError:
+                self._sendfile = False  # Do not try again
+            except RuntimeError as e:
+                # Raised if the transport is closing, like a lost connection
+                if not transport.is_closing():
+                    raise
+                raise ConnectionResetError("Connection lost") from e
+            else:
+                record = self.record
+                record.bytes_sent += length
+                record.writes += 1
+                self.stats.bytes_sent += length
+                record.last_active = time.monotonic()
+                record.drain_time += record.last_active - started
+                return
+        await self.write_and_drain(view[offset : offset + length])
 
-    def change_rate_limit(self, rate: int):
+    def _set_kernel_pacing(self, rate: int) -> bool:
+        """
+        Let the kernel pace this socket at "rate" bytes per second, with
+        SO_MAX_PACING_RATE. Negative rate removes the limit.
+
+        Returns False if the option is not supported or rejected.
+        """
+        if not sys.platform.startswith("linux"):
+            return False
+        sock = self.__writer.get_extra_info("socket")
+        if sock is None:
+            return False
+        if rate < 0:
+            rate = -1  # ~0U means unlimited
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, rate)
+        except (OSError, OverflowError) as e:
+            logging.debug("SO_MAX_PACING_RATE rejected: %s", e)
+            return False
+        return True
+
+    def change_rate_limit(self, rate: int | float):
         # logging.debug(f"rate limit: {rate}")
         self.rate = rate
+        if self._parent_bucket is not None or rate != int(rate):
+            # Bandwidth is shared, or rate is fractional
+            if rate > 0:
+                self._bucket = TokenBucket(rate, parent=self._parent_bucket)
+                step = int(rate)
+                if self._parent_bucket is not None:
+                    # Small steps, so connections sharing the bucket take
+                    # turns
+                    step = int(min(rate, self._parent_bucket.rate)) // 8
+                self._bucket_step = max(1, min(step, 512))
+            elif rate < 0:
+                # One byte every |rate| seconds
+                self._bucket = TokenBucket(
+                    1 / abs(rate), 1, parent=self._parent_bucket
+                )
+                self._bucket_step = 1
+            else:
+                self._bucket = self._parent_bucket
+                assert self._bucket is not None
+                # Small steps, so connections sharing the bucket take turns
+                step = int(self._bucket.rate) // 8
+                self._bucket_step = max(1, min(step, 512))
+            self.write_and_drain = self._write_with_bucket
+            return
+        if self.pacing == "kernel":
+            if rate > 0:
+                self._kernel_paced = self._set_kernel_pacing(rate)
+            elif self._kernel_paced:
+                self._set_kernel_pacing(-1)
+                self._kernel_paced = False
         if rate == 0:
             write_inner = self._write_normal
+        elif self._kernel_paced:
+            # Hand the whole buffer to the transport, no wakeup needed
+            write_inner = self._write_normal
+        elif self.pacing == "wheel":
+            write_inner = self._write_with_wheel
         elif rate < 0:
             write_inner = self._write_with_interval
         else:
@@ -425,8 +1649,26 @@ class TarpitWriter:
     def wait_closed(self):
         return self.__writer.wait_closed()
 
-    def __init__(self, rate, writer: asyncio.StreamWriter) -> None:
+    def __init__(
+        self,
+        rate,
+        writer: asyncio.StreamWriter,
+        pacing: str = "userspace",
+        bucket: TokenBucket | None = None,
+        record: "ClientRecord | None" = None,
+        stall_timeout: float = 0,
+        stats: "TarpitStats | None" = None,
+    ) -> None:
         self.__writer = writer
+        self.record = record or ClientRecord(None)
+        self.stall_timeout = stall_timeout
+        self.stats = stats or TarpitStats()
+        self.pacing = pacing
+        self._kernel_paced = False
+        self._parent_bucket = bucket
+        self._bucket: TokenBucket | None = None
+        self._bucket_step = 1
+        self._sendfile = True
         self.drain = writer.drain
         # self.close = writer.close
         # self.wait_closed = writer.wait_closed
@@ -486,36 +1728,923 @@ class TarpitReader:
                 pass
         pass
 
-    def dump_data(self):
-        return self.__buffer
+    def dump_data(self):
+        return self.__buffer
+
+    def record_passively(self) -> bool:
+        """
+        Let the connection feed incoming data into the recording buffer,
+        so no coroutine is needed to keep reading.
+
+        Returns False if the underlying reader does not support it.
+        """
+        set_sink = getattr(self.__reader, "set_sink", None)
+        if set_sink is None:
+            return False
+        # Nothing more is read once the recording is full
+        set_sink(self._record_data, self._recording - len(self.__buffer))
+        return True
+
+    def unread(self, data: bytes):
+        """
+        Put data back, so the next read() returns it first. It has been
+        recorded already, so it is not recorded again.
+        """
+        self.__pending = bytes(data) + self.__pending
+
+    async def read(self, n=-1):
+        if self.__pending:
+            if n < 0:
+                n = len(self.__pending)
+            data, self.__pending = self.__pending[:n], self.__pending[n:]
+            return data
+        data = await self.__reader.read(n)
+        self._record_data(data)
+        return data
+
+    def __init__(self, recording, reader: asyncio.StreamReader) -> None:
+        self.__reader = reader
+        self.__buffer = bytearray()
+        self.__pending = b""
+        self._recording = recording  # Zero is disable. default to 768
+
+    pass
+
+
+async def read_with_timeout(
+    reader: ReaderProtocol, n: int, timeout: float
+) -> bytes:
+    data = bytearray()
+    try:
+        async with asyncio.timeout(timeout):
+            while len(data) < n:
+                chunk = await reader.read(n - len(data))
+                if not chunk:
+                    break
+                data.extend(chunk)
+    except asyncio.TimeoutError:
+        pass
+    return bytes(data)
+
+
+class TarpitProtocol(asyncio.Protocol):
+    """
+    A light-weight connection core built directly on asyncio.Protocol.
+
+    asyncio.start_server creates a StreamReader (with a 64 KiB buffer), a
+    StreamReaderProtocol and a StreamWriter for every client. This class
+    replaces all of them with one small object, and offers the subset of
+    their API used by TarpitReader and TarpitWriter, so existing patterns
+    work unchanged. Incoming data is kept in a small bounded buffer, and
+    reading is paused when it is full.
+    """
+
+    __slots__ = (
+        "transport",
+        "_handler",
+        "_task",
+        "_buffer",
+        "_limit",
+        "_eof",
+        "_exc",
+        "_sink",
+        "_sink_left",
+        "_read_waiter",
+        "_drain_waiter",
+        "_close_waiter",
+        "_write_paused",
+        "_read_paused",
+        "_lost",
+    )
+
+    def __init__(self, handler, limit: int = 1024) -> None:
+        self.transport: asyncio.Transport
+        self._handler = handler
+        self._task: asyncio.Task | None = None
+        self._buffer = bytearray()
+        self._limit = limit
+        self._eof = False
+        self._exc: BaseException | None = None
+        self._sink: typing.Callable[[bytes], None] | None = None
+        self._sink_left = 0
+        self._read_waiter: asyncio.Future | None = None
+        self._drain_waiter: asyncio.Future | None = None
+        self._close_waiter: asyncio.Future | None = None
+        self._write_paused = False
+        self._read_paused = False
+        self._lost = False
+
+    @staticmethod
+    def _wakeup(waiter: asyncio.Future | None, exc=None):
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    # asyncio.Protocol callbacks
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self._task = asyncio.get_running_loop().create_task(
+            self._handler(self, self)
+        )
+
+    def data_received(self, data: bytes) -> None:
+        if self._sink is not None:
+            self._feed_sink(data)
+            return
+        self._buffer.extend(data)
+        if len(self._buffer) >= self._limit and not self._read_paused:
+            self._read_paused = True
+            self.transport.pause_reading()
+        self._wakeup(self._read_waiter)
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup(self._read_waiter)
+        return True  # Keep the transport open, we may still write
+
+    def connection_lost(self, exc) -> None:
+        self._lost = True
+        self._exc = exc
+        self._eof = True
+        self._wakeup(self._read_waiter)
+        self._wakeup(
+            self._drain_waiter,
+            exc or ConnectionResetError("Connection lost"),
+        )
+        self._wakeup(self._close_waiter)
+
+    def pause_writing(self) -> None:
+        self._write_paused = True
+
+    def resume_writing(self) -> None:
+        self._write_paused = False
+        self._wakeup(self._drain_waiter)
+
+    # StreamReader like API
+
+    async def read(self, n: int = -1) -> bytes:
+        if self._exc is not None and not self._buffer:
+            raise self._exc
+        if not self._buffer and not self._eof:
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+        if n < 0 or n >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+        if self._read_paused and len(self._buffer) < self._limit:
+            self._read_paused = False
+            self.transport.resume_reading()
+        return data
+
+    def set_exception(self, exc) -> None:
+        self._exc = exc
+
+    def set_sink(
+        self, sink: typing.Callable[[bytes], None], limit: int
+    ) -> None:
+        """
+        Feed incoming data to sink instead of buffering it, and stop
+        reading once limit bytes have been fed.
+
+        Used by patterns which only record the request and never read it.
+        """
+        self._sink = sink
+        self._sink_left = limit
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self._feed_sink(data)
+        if self._sink_left > 0 and self._read_paused and not self._lost:
+            self._read_paused = False
+            self.transport.resume_reading()
+
+    def _feed_sink(self, data: bytes) -> None:
+        assert self._sink is not None
+        if self._sink_left > 0:
+            self._sink(data[: self._sink_left])
+            self._sink_left -= len(data)
+        if self._sink_left <= 0 and not self._read_paused and not self._lost:
+            self._read_paused = True
+            self.transport.pause_reading()
+
+    # StreamWriter like API
+
+    def write(self, data) -> None:
+        self.transport.write(data)
+
+    async def drain(self) -> None:
+        if self.transport.is_closing():
+            # Same as StreamWriter, yield to let connection_lost() run
+            await asyncio.sleep(0)
+            if self._exc is not None:
+                raise self._exc
+            raise ConnectionResetError("Connection lost")
+        if self._write_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def close(self) -> None:
+        self.transport.close()
+
+    async def wait_closed(self) -> None:
+        if self._lost:
+            return
+        if self._close_waiter is None:
+            self._close_waiter = asyncio.get_running_loop().create_future()
+        await self._close_waiter
+
+
+class StaticProtocol(asyncio.Protocol):
+    """
+    Serves a client of a StaticTarpit from transport callbacks, without
+    a task.
+
+    Used by the protocol backend for patterns with a stream(), when the
+    writes need no coroutine: an integer rate limit, userspace or wheel
+    pacing, and no bandwidth limit. It does what BaseTarpit and
+    StaticTarpit do in a task (admission, validation, pacing, parking,
+    accounting and logging) as a state machine run by timers and
+    futures. The first RECORD bytes from the client are recorded, then
+    reading is paused.
+    """
+
+    RECORD: int = 1024
+
+    __slots__ = (
+        "transport",
+        "_tarpit",
+        "_validate",
+        "_record",
+        "_address",
+        "_source",
+        "_admission",
+        "_opened",
+        "_request",
+        "_validating",
+        "_eof",
+        "_stream",
+        "_then",
+        "_chunk",
+        "_pos",
+        "_due",
+        "_rate",
+        "_waiter",
+        "_drain_waiter",
+        "_started",
+        "_write_paused",
+        "_closed",
+    )
+
+    def __init__(self, tarpit: "StaticTarpit", validate: bool) -> None:
+        self.transport: asyncio.Transport
+        self._tarpit = tarpit
+        self._validate = validate
+        self._record: ClientRecord | None = None
+        self._address: bytes | None = None
+        self._source = None
+        # Set while waiting in the admission queue
+        self._admission: asyncio.Future | None = None
+        self._opened = False
+        self._request = bytearray()
+        self._validating = False
+        self._eof = False
+        self._stream: typing.Iterator | None = None
+        self._then: typing.Callable[[], None] | None = None
+        self._chunk: memoryview | None = None
+        self._pos = 0
+        # The timer before the next step has fired
+        self._due = False
+        self._rate: int = 0
+        # The timer, wheel job or drain the connection is waiting for
+        self._waiter: asyncio.TimerHandle | asyncio.Future | None = None
+        self._drain_waiter: asyncio.Future | None = None
+        self._started = 0.0
+        self._write_paused = False
+        self._closed = False
+
+    # asyncio.Protocol callbacks
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        tarpit = self._tarpit
+        accepted, self._address, self._source = tarpit._open_client(self)
+        if not accepted:
+            # With over_limit "hold", data is dropped until the client
+            # leaves
+            if tarpit._config.over_limit != "hold":
+                transport.close()
+            return
+        record = self._record = ClientRecord(self)
+        admitted = tarpit._try_admit(record)
+        if admitted is True:
+            self._open()
+        elif admitted is False:
+            self._record = None
+            self._release_source()
+            tarpit._reject(self, "max_clients")
+            transport.close()
+        else:
+            self._admission = admitted
+            admitted.add_done_callback(self._admitted)
+
+    def data_received(self, data: bytes) -> None:
+        if self._record is None:
+            return
+        request = self._request
+        free = self.RECORD - len(request)
+        if free > 0:
+            request += data[:free]
+        if self._validating:
+            if len(request) >= self._tarpit._validator_config.read_len:
+                self._check_head()
+        elif len(request) >= self.RECORD:
+            self.transport.pause_reading()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        if self._record is None:
+            return False  # Close the held connection
+        if self._validating:
+            self._check_head()
+        return True  # Keep the transport open, we may still write
+
+    def connection_lost(self, exc) -> None:
+        self._closed = True
+        self._cancel_waiter()
+        record = self._record
+        if record is None:
+            return
+        tarpit = self._tarpit
+        if self._admission is not None:
+            tarpit._leave_queue(self._admission, record)
+            self._admission = None
+        if self._opened:
+            if isinstance(exc, OSError):
+                tarpit._conn_error(self, exc)
+            elif exc is not None:
+                tarpit.logger.error("connection lost: %r", exc)
+            tarpit._close_client(self, record, self._address, self._request)
+            tarpit._release(record)
+        self._release_source()
+
+    def pause_writing(self) -> None:
+        self._write_paused = True
+
+    def resume_writing(self) -> None:
+        self._write_paused = False
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def cancel(self) -> None:
+        """
+        Close the connection. Admission control calls it to evict the
+        client, as ClientRecord.task.
+        """
+        self._closed = True
+        self._cancel_waiter()
+        self.transport.close()
+
+    # States of the connection
+
+    def _admitted(self, future: asyncio.Future) -> None:
+        if future is not self._admission:
+            return  # Left the queue
+        self._admission = None
+        self._open()
+
+    def _open(self) -> None:
+        self._opened = True
+        tarpit = self._tarpit
+        tarpit._runtime_log_client(self, "open")
+        if self._validate:
+            banner = tarpit._validator_config.banner
+            self._send_all((banner,), 128, self._read_head)
+        else:
+            self._serve()
+
+    def _read_head(self) -> None:
+        conf = self._tarpit._validator_config
+        self._validating = True
+        if len(self._request) >= conf.read_len or self._eof:
+            self._check_head()
+            return
+        self._waiter = asyncio.get_running_loop().call_later(
+            conf.timeout, self._check_head
+        )
+
+    def _check_head(self) -> None:
+        self._validating = False
+        self._cancel_waiter()
+        tarpit = self._tarpit
+        conf = tarpit._validator_config
+        data = bytes(self._request[: conf.read_len])
+        expected = any(data.startswith(head) for head in conf.head_allowlist)
+        result = tarpit.ValidationResult(expected, data)
+        if expected:
+            if data:
+                tarpit.stats.validation_passed += 1
+                tarpit._runtime_log_client(
+                    self, "validate", meta=result._asdict()
+                )
+            self._serve()
+        else:
+            tarpit.stats.validation_failed += 1
+            tarpit._runtime_log_client(self, "validate", meta=result._asdict())
+            self._send_all((conf.response_failed,), 128, self._linger)
+        if len(self._request) >= self.RECORD:
+            self.transport.pause_reading()
+
+    def _linger(self) -> None:
+        self._waiter = asyncio.get_running_loop().call_later(
+            random.randrange(16, 32), self.cancel
+        )
+
+    def _serve(self) -> None:
+        tarpit = self._tarpit
+        stream = tarpit.stream() or ()
+        self._send_all(stream, tarpit._config.rate_limit, self.cancel)
+
+    def _release_source(self) -> None:
+        source, self._source = self._source, None
+        if source is not None:
+            self._tarpit._sources.release(source)
+
+    def _cancel_waiter(self) -> None:
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.cancel()
+
+    # Writing, the same way as TarpitWriter.write_and_drain()
+
+    def _send_all(self, stream, rate: int, then) -> None:
+        """
+        Send the chunks of stream under the rate limit, then call then().
+        """
+        self._stream = iter(stream)
+        self._rate = rate
+        self._then = then
+        self._chunk = None
+        self._send()
+
+    def _send(self) -> None:
+        # Write until a timer, the wheel or the client makes us wait
+        try:
+            while self._waiter is None and not self._closed:
+                chunk = self._chunk
+                if chunk is None or self._pos >= len(chunk):
+                    data = next(self._stream, None)
+                    if data is None:
+                        self._then()
+                        return
+                    if type(data) is not memoryview:
+                        data = memoryview(data)
+                    self._chunk = data
+                    self._pos = 0
+                    continue
+                self._step(chunk)
+        except Exception as e:
+            self._tarpit.logger.exception(e)
+            self.cancel()
+
+    def _step(self, chunk: memoryview) -> None:
+        rate = self._rate
+        pos = self._pos
+        if rate == 0:
+            self._pos = len(chunk)
+            self._write(chunk[pos:])
+        elif self._tarpit._config.pacing == "wheel":
+            step, interval = (rate, 1) if rate > 0 else (1, -rate)
+            waiter = PacingWheel.get().submit(
+                self.transport, chunk[pos:], step, interval
+            )
+            self._waiter = waiter
+            waiter.add_done_callback(self._wheeled)
+        elif not self._due and (rate < 0 or len(chunk) - pos >= rate):
+            # One byte every |rate| seconds, or rate bytes every second
+            self._waiter = asyncio.get_running_loop().call_later(
+                -rate if rate < 0 else 1, self._wake
+            )
+        else:
+            self._due = False
+            step = max(rate, 1)
+            self._pos = pos + step
+            self._write(chunk[pos : pos + step])
+
+    def _wake(self) -> None:
+        self._waiter = None
+        self._due = True
+        self._send()
+
+    def _write(self, data: memoryview) -> None:
+        self.transport.write(data)
+        record = self._record
+        assert record is not None
+        record.bytes_sent += len(data)
+        record.writes += 1
+        self._tarpit.stats.bytes_sent += len(data)
+        self._started = time.monotonic()
+        self._wait_drain(self._tarpit._config.stall_timeout)
+
+    def _wheeled(self, future: asyncio.Future) -> None:
+        if future is not self._waiter:
+            return  # Cancelled
+        self._waiter = None
+        if future.exception() is not None:
+            self.cancel()  # The connection is lost
+            return
+        chunk = self._chunk
+        assert chunk is not None and self._record is not None
+        length = len(chunk) - self._pos
+        self._pos = len(chunk)
+        record = self._record
+        record.bytes_sent += length
+        record.writes += -(-length // max(self._rate, 1))
+        self._tarpit.stats.bytes_sent += length
+        self._started = time.monotonic()
+        self._wait_drain(0)
+        self._send()
+
+    def _wait_drain(self, stall_timeout: float) -> None:
+        transport = self.transport
+        if stall_timeout and (
+            transport.get_write_buffer_size()
+            > transport.get_write_buffer_limits()[1]
+        ):
+            # The client may have stopped reading, wait in the lot
+            waiter = ParkingLot.get().wait(
+                transport, stall_timeout, self._tarpit.stats
+            )
+        elif self._write_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiter = waiter
+        else:
+            record = self._record
+            assert record is not None
+            record.last_active = time.monotonic()
+            record.drain_time += record.last_active - self._started
+            return
+        self._waiter = waiter
+        waiter.add_done_callback(self._drained)
+
+    def _drained(self, future: asyncio.Future) -> None:
+        if future is not self._waiter:
+            return  # Cancelled
+        self._waiter = None
+        if future.exception() is not None:
+            self.cancel()  # The connection is lost
+            return
+        self._wait_drain(0)
+        self._send()
+
+
+class ClientTraceWriter:
+    """
+    Writes client trace events from a background thread.
+
+    The event loop only puts a tuple on a bounded queue. The thread takes
+    up to BATCH events at a time, serializes them to JSON lines and writes
+    them with a single write() call. What happens when the queue is full
+    depends on "overflow":
 
-    async def read(self, n=-1):
-        data = await self.__reader.read(n)
-        self._record_data(data)
-        return data
+    - "drop": new events are dropped.
+    - "sample": once the queue is half full, only one of every "sample"
+      events is kept. Events are dropped when it is full.
+    - "block": the event loop waits for the thread. Nothing is lost, but
+      all connections stall with it.
 
-    def __init__(self, recording, reader: asyncio.StreamReader) -> None:
-        self.__reader = reader
-        self.__buffer = bytearray()
-        self._recording = recording  # Zero is disable. default to 768
+    Dropped events are counted, and reported to the main log every
+    "report" seconds.
 
-    pass
+    Queued events are written out by close(), which run_server() calls
+    when it stops, also on SIGTERM.
 
+    With "trace_format" set to "binary", every batch is written as one
+    self-contained block, see encode_block(). Use read_blocks() or
+    `tarpitd.py --convert-trace` to turn it back into jsonl.
+    """
 
-async def read_with_timeout(
-    reader: ReaderProtocol, n: int, timeout: float
-) -> bytes:
-    data = bytearray()
-    try:
-        async with asyncio.timeout(timeout):
-            while len(data) < n:
-                chunk = await reader.read(n - len(data))
-                if not chunk:
+    BATCH: int = 512
+    MAGIC: bytes = b"TPT1"
+
+    process_wide: "ClientTraceWriter | None" = None
+
+    def __init__(
+        self,
+        path: str,
+        max_queue: int = 65536,
+        overflow: str = "drop",
+        sample: int = 16,
+        report: float = 60,
+        trace_format: str = "jsonl",
+    ) -> None:
+        self.path = path
+        self.trace_format = trace_format
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.sample = max(1, sample)
+        self.report = report
+        self.dropped = 0
+        self.dropped_sampled = 0
+        self._reported = 0
+        self._seen = 0
+        self._queue: queue.Queue | None = None
+        self._thread: threading.Thread | None = None
+        self._pid = 0
+
+    def _start(self):
+        # Also called in forked workers, threads do not survive fork()
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.max_queue)
+        self._thread = threading.Thread(
+            target=self._run, name="client_trace", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, event: tuple):
+        """
+        Queue an event: (time, event, name, pattern, peername, sockname,
+        meta). Never blocks unless overflow is "block".
+        """
+        if self._pid != os.getpid():
+            self._start()
+        q = self._queue
+        assert q is not None
+        if self.overflow == "block":
+            q.put(event)
+            return
+        if self.overflow == "sample" and q.qsize() * 2 >= self.max_queue:
+            self._seen += 1
+            if self._seen % self.sample:
+                self.dropped_sampled += 1
+                return
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def format(event: tuple) -> str:
+        stamp, name, tarpit_name, pattern, peername, sockname, meta = event
+        return json.dumps(
+            {
+                "time": stamp,
+                "event": name,
+                "name": tarpit_name,
+                "pattern": pattern,
+                "conn_info": {"peername": peername, "sockname": sockname},
+                "meta": meta,
+            },
+            cls=BytesLiteralEncoder,
+        )
+
+    @staticmethod
+    def _pack_addr(addr) -> bytes:
+        if addr is None:
+            return b"\0"
+        try:
+            if len(addr) == 2:
+                return b"\4" + socket.inet_pton(socket.AF_INET, addr[0]) + (
+                    struct.pack("!H", addr[1])
+                )
+            if len(addr) == 4:
+                return b"\6" + socket.inet_pton(socket.AF_INET6, addr[0]) + (
+                    struct.pack("!HII", *addr[1:])
+                )
+        except (OSError, TypeError, ValueError, struct.error):
+            pass
+        # Scoped IPv6 address, UNIX socket and so on
+        data = json.dumps(addr).encode()
+        return b"\xff" + struct.pack("!H", len(data)) + data
+
+    @staticmethod
+    def _unpack_addr(view, pos: int):
+        kind = view[pos]
+        pos += 1
+        match kind:
+            case 0:
+                return None, pos
+            case 4:
+                host = socket.inet_ntop(socket.AF_INET, view[pos : pos + 4])
+                (port,) = struct.unpack_from("!H", view, pos + 4)
+                return (host, port), pos + 6
+            case 6:
+                host = socket.inet_ntop(socket.AF_INET6, view[pos : pos + 16])
+                rest = struct.unpack_from("!HII", view, pos + 16)
+                return (host, *rest), pos + 26
+        (length,) = struct.unpack_from("!H", view, pos)
+        pos += 2
+        return json.loads(bytes(view[pos : pos + length])), pos + length
+
+    @classmethod
+    def encode_block(cls, events: list[tuple]) -> bytes:
+        """
+        Encode events into a binary block. All integers are big-endian.
+
+            block   = "TPT1" u32:length u16:count string* record*
+            string  = u16:length utf-8
+            record  = u32:length f64:time u16:event u16:name u16:pattern
+                      addr:peername addr:sockname u8:meta_type meta
+            addr    = u8:0 | u8:4 ip4 u16:port
+                    | u8:6 ip6 u16:port u32:flowinfo u32:scope_id
+                    | u8:255 u16:length json
+            meta    = (0) nothing | (1) raw request bytes | (2) json
+                    | (3) u32:length raw request bytes, json of other keys
+
+        event, name and pattern are indexes into the strings of the block.
+        Every block is self-contained, so blocks written by several
+        workers can be interleaved in one file.
+        """
+        strings: dict[str, int] = {}
+        records = []
+        for stamp, event, name, pattern, peername, sockname, meta in events:
+            ids = []
+            for string in (event, name, pattern):
+                ids.append(strings.setdefault(string, len(strings)))
+            request = meta.get("request") if meta else None
+            if meta is None:
+                meta_data = b"\0"
+            elif not isinstance(request, (bytes, bytearray)) or (
+                next(iter(meta)) != "request"
+            ):
+                meta_data = b"\2" + json.dumps(
+                    meta, cls=BytesLiteralEncoder
+                ).encode()
+            elif len(meta) == 1:
+                meta_data = b"\1" + request
+            else:
+                # The close event, with the accounting of the connection
+                rest = {k: v for k, v in meta.items() if k != "request"}
+                meta_data = b"".join(
+                    (
+                        b"\3",
+                        struct.pack("!I", len(request)),
+                        request,
+                        json.dumps(rest, cls=BytesLiteralEncoder).encode(),
+                    )
+                )
+            record = b"".join(
+                (
+                    struct.pack("!dHHH", stamp, *ids),
+                    cls._pack_addr(peername),
+                    cls._pack_addr(sockname),
+                    meta_data,
+                )
+            )
+            records.append(struct.pack("!I", len(record)) + record)
+        table = [struct.pack("!H", len(strings))]
+        for string in strings:
+            data = string.encode()
+            table.append(struct.pack("!H", len(data)) + data)
+        body = b"".join(table + records)
+        return cls.MAGIC + struct.pack("!I", len(body)) + body
+
+    @classmethod
+    def read_blocks(cls, stream: typing.BinaryIO) -> typing.Iterator[tuple]:
+        """
+        Read a binary trace from stream one block at a time, and yield
+        its events in the same form as ClientTraceWriter.put() takes.
+        """
+        while head := stream.read(8):
+            if len(head) < 8 or head[:4] != cls.MAGIC:
+                raise ValueError("not a binary client trace")
+            (length,) = struct.unpack("!I", head[4:])
+            view = memoryview(stream.read(length))
+            if len(view) < length:
+                raise ValueError("truncated client trace")
+            (count,), pos = struct.unpack_from("!H", view), 2
+            strings = []
+            for _ in range(count):
+                (size,) = struct.unpack_from("!H", view, pos)
+                strings.append(str(view[pos + 2 : pos + 2 + size], "utf-8"))
+                pos += 2 + size
+            while pos < length:
+                (size,) = struct.unpack_from("!I", view, pos)
+                end = pos + 4 + size
+                stamp, event, name, pattern = struct.unpack_from(
+                    "!dHHH", view, pos + 4
+                )
+                peername, pos = cls._unpack_addr(view, pos + 18)
+                sockname, pos = cls._unpack_addr(view, pos)
+                meta_type = view[pos]
+                if meta_type == 0:
+                    meta = None
+                elif meta_type == 1:
+                    meta = {"request": bytes(view[pos + 1 : end])}
+                elif meta_type == 3:
+                    (size,) = struct.unpack_from("!I", view, pos + 1)
+                    pos += 5
+                    meta = {"request": bytes(view[pos : pos + size])}
+                    meta.update(json.loads(bytes(view[pos + size : end])))
+                else:
+                    meta = json.loads(bytes(view[pos + 1 : end]))
+                pos = end
+                yield (
+                    stamp,
+                    strings[event],
+                    strings[name],
+                    strings[pattern],
+                    peername,
+                    sockname,
+                    meta,
+                )
+
+    def _open(self):
+        match self.path:
+            case "<stdout>":
+                return sys.stdout.buffer, False
+            case "<stderr>":
+                return sys.stderr.buffer, False
+            case _:
+                # Unbuffered, so every batch is one append, even when
+                # several workers share the file
+                return open(self.path, "ab", buffering=0), True
+
+    def _run(self):
+        q = self._queue
+        assert q is not None
+        stream, owned = self._open()
+        last_report = time.monotonic()
+        running = True
+        while running:
+            try:
+                # Wake up to report drops even if nothing is queued
+                batch = [q.get(timeout=self.report or None)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.BATCH:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
                     break
-                data.extend(chunk)
-    except asyncio.TimeoutError:
-        pass
-    return bytes(data)
+            if None in batch:  # close()
+                batch.remove(None)
+                running = False
+            if not batch:
+                data = b""
+            elif self.trace_format == "binary":
+                data = self.encode_block(batch)
+            else:
+                data = "".join(self.format(e) + "\n" for e in batch).encode()
+            try:
+                self._write(stream, data)
+            except (OSError, ValueError) as e:
+                logging.error("failed to write client trace: %s", e)
+            now = time.monotonic()
+            if self.report and now - last_report >= self.report:
+                last_report = now
+                self._report()
+        self._report()
+        if owned:
+            stream.close()
+
+    @staticmethod
+    def _write(stream, data: bytes):
+        # An unbuffered file may take only part of the data
+        view = memoryview(data)
+        while view:
+            view = view[stream.write(view) :]
+        stream.flush()
+
+    def _report(self):
+        dropped = self.dropped + self.dropped_sampled
+        if dropped != self._reported:
+            logging.warning(
+                "client trace queue full, %d events dropped, %d sampled out",
+                self.dropped,
+                self.dropped_sampled,
+            )
+            self._reported = dropped
+
+    def close(self):
+        """
+        Write the remaining events and stop the thread.
+        """
+        if self._thread is None or self._pid != os.getpid():
+            return
+        assert self._queue is not None
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._pid = 0
 
 
 class BaseTarpit:
@@ -534,7 +2663,27 @@ class BaseTarpit:
         # Not real connection count. More than 4096 will be created, but will wait in queue
         # https://docs.python.org/3/library/socket.html#socket.socket.listen
         # default backlog is 100
-        rate_limit: int = 1
+        admission: str = "queue"
+        max_queue: int = 1024
+        max_clients_per_ip: int = 0
+        max_clients_per_prefix: int = 0
+        prefix_v4: int = 24
+        prefix_v6: int = 64
+        over_limit: str = "close"
+        tcp_user_timeout: int = 0
+        keepalive: bool = False
+        keepidle: int = 0
+        keepintvl: int = 0
+        keepcnt: int = 0
+        stall_timeout: float = 0
+        analytics: bool = False
+        analytics_top: int = 64
+        analytics_interval: float = 300
+        rate_limit: int | float = 1
+        bandwidth: float = 0
+        bandwidth_burst: float = 0
+        pacing: str = "userspace"
+        backend: str = "stream"
         client_trace: int = 0
         client_validation: bool = True
 
@@ -560,23 +2709,20 @@ class BaseTarpit:
     def __log_client(
         self, writer: asyncio.StreamWriter, event: str, meta=None
     ) -> None:
-        self.client_trace_logger.info(
-            json.dumps(
-                {
-                    "time": time.time(),
-                    "event": event,
-                    "name": self._config.name,
-                    "pattern": self.PATTERN_NAME,
-                    "conn_info": {
-                        "peername": writer.get_extra_info("peername"),
-                        "sockname": writer.get_extra_info("sockname"),
-                    },
-                    "meta": meta,
-                },
-                cls=BytesLiteralEncoder,
-            )
+        record = (
+            time.time(),
+            event,
+            self._config.name,
+            self.PATTERN_NAME,
+            writer.get_extra_info("peername"),
+            writer.get_extra_info("sockname"),
+            meta,
         )
-        pass
+        trace_writer = ClientTraceWriter.process_wide
+        if trace_writer is not None:
+            trace_writer.put(record)
+        else:
+            self.client_trace_logger.info(ClientTraceWriter.format(record))
 
     async def _handler(
         self,
@@ -585,12 +2731,251 @@ class BaseTarpit:
     ):
         raise NotImplementedError
 
+    def _set_serving(self, serving: bool):
+        """
+        Pause or resume accepting new connections on all listening sockets
+        of this tarpit, so pending connections stay in the kernel backlog.
+
+        asyncio.Server has no public API for this. It works by taking the
+        accept callback out of the selector, and adding it back later, so
+        it needs the default selector event loop. create_server() checks
+        it with _can_pause().
+        """
+        for server in self._servers:
+            loop = server.get_loop()
+            selector = loop._selector  # type: ignore
+            for sock in server.sockets:
+                fd = sock.fileno()
+                if serving:
+                    callback = self._accept_callbacks.pop(fd, None)
+                    if callback is not None:
+                        loop.add_reader(fd, callback[0], *callback[1])
+                elif fd not in self._accept_callbacks:
+                    try:
+                        handle = selector.get_key(fd).data[0]
+                    except (KeyError, ValueError):
+                        continue
+                    # Removing the reader cancels the handle, save it first
+                    self._accept_callbacks[fd] = (handle._callback, handle._args)
+                    loop.remove_reader(fd)
+        self._paused = not serving
+
+    @staticmethod
+    def _can_pause(loop: asyncio.AbstractEventLoop) -> bool:
+        """
+        Returns True if _set_serving() works with loop.
+        """
+        selector = getattr(loop, "_selector", None)
+        return (
+            isinstance(loop, asyncio.SelectorEventLoop)
+            and isinstance(selector, selectors.BaseSelector)
+            and {"_callback", "_args"} <= set(asyncio.Handle.__slots__)
+        )
+
+    def _try_admit(self, record: ClientRecord) -> bool | asyncio.Future:
+        """
+        Decide whether a new client gets a slot, according to "admission".
+
+        Returns False if the client should be rejected, True if it got a
+        slot, or a future which is done when a slot is handed over to it.
+        Call _leave_queue() if the client leaves before.
+        """
+        conf = self._config
+        if len(self._clients) < conf.max_clients and not self._waiters:
+            self._clients[record] = None
+            if conf.admission == "pause" and (
+                len(self._clients) >= conf.max_clients
+            ):
+                self._set_serving(False)
+            return True
+        match conf.admission:
+            case "reject":
+                return False
+            case "evict_oldest" | "evict_idle":
+                if conf.admission == "evict_oldest":
+                    victim = next(iter(self._clients))
+                else:
+                    victim = min(self._clients, key=lambda r: r.last_active)
+                del self._clients[victim]
+                if victim.task is not None:
+                    victim.task.cancel()
+                self._clients[record] = None
+                return True
+        # "queue" and "pause", wait for a free slot
+        if len(self._waiters) >= conf.max_queue:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((waiter, record))
+        return waiter
+
+    def _leave_queue(self, waiter: asyncio.Future, record: ClientRecord):
+        if waiter.done() and not waiter.cancelled():
+            self._release(record)  # The slot was handed to us
+        else:
+            self._waiters.remove((waiter, record))
+
+    async def _admit(self, record: ClientRecord) -> bool:
+        """
+        Same as _try_admit(), but waits in the queue.
+        """
+        waiter = self._try_admit(record)
+        if isinstance(waiter, bool):
+            return waiter
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            self._leave_queue(waiter, record)
+            raise
+        return True
+
+    def _release(self, record: ClientRecord):
+        if record not in self._clients:
+            return  # Evicted
+        del self._clients[record]
+        # Hand over the slot to the first waiter
+        while self._waiters:
+            waiter, waiting_record = self._waiters.popleft()
+            if not waiter.done():
+                self._clients[waiting_record] = None
+                waiter.set_result(None)
+                return
+        if self._paused and len(self._clients) < self._config.max_clients:
+            self._set_serving(True)
+
+    def _make_socket_options(self) -> list[tuple[int, int, int]]:
+        conf = self._config
+        options = []
+        if conf.keepalive:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for name, value in (
+            ("TCP_USER_TIMEOUT", conf.tcp_user_timeout),
+            ("TCP_KEEPIDLE", conf.keepidle),
+            ("TCP_KEEPINTVL", conf.keepintvl),
+            ("TCP_KEEPCNT", conf.keepcnt),
+        ):
+            if not value:
+                continue
+            if not hasattr(socket, name):
+                self.logger.warning("%s is not supported, ignored", name)
+                continue
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        return options
+
+    def _apply_socket_options(self, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is None:
+            return
+        for level, option, value in self._socket_options:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                self.logger.debug("failed to set socket option: %s", e)
+
+    async def _hold(self, reader):
+        """
+        Keep the connection open without writing anything, until the
+        client leaves.
+        """
+        try:
+            while await reader.read(1024):
+                pass
+        except OSError:
+            pass
+
+    def _open_client(self, writer) -> tuple[bool, bytes | None, typing.Any]:
+        """
+        Count and set up a new connection, and check the per-source limits.
+
+        Returns whether the client is accepted, its packed address for
+        analytics, and its source keys, to be released when it leaves.
+        """
+        self.stats.accepted += 1
+        if self._socket_options:
+            self._apply_socket_options(writer)
+        address = None
+        if self._unique_sources is not None:
+            address = pack_address(writer.get_extra_info("peername"))
+            if address is not None:
+                self._unique_sources.add(address)
+        source = None
+        if self._sources is not None:
+            source = self._sources.keys(writer.get_extra_info("peername"))
+            reason = self._sources.acquire(source) if source else None
+            if reason is not None:
+                self._reject(writer, reason)
+                return False, address, None
+        return True, address, source
+
+    def _reject(self, writer, reason: str):
+        self.stats.rejected[reason] += 1
+        self._runtime_log_client(writer, "reject", meta={"reason": reason})
+
+    def _conn_error(self, writer, e: OSError):
+        """
+        Count and log an error which ended the connection to a client.
+        """
+        name = e.__class__.__name__
+        if name not in self.stats.conn_errors:
+            name = "other"
+        if isinstance(e, TimeoutError):
+            # TCP_USER_TIMEOUT or keepalive found a dead peer
+            self.stats.dead_peer_reclaimed += 1
+            self.logger.debug(
+                "reclaimed dead peer, %d so far, %d slots in use",
+                self.stats.dead_peer_reclaimed,
+                len(self._clients),
+            )
+        self.stats.conn_errors[name] += 1
+        self._runtime_log_client(
+            writer,
+            "conn_error",
+            meta={"err": e.__class__.__name__, "msg": str(e)},
+        )
+
+    def _close_client(
+        self, writer, record: ClientRecord, address, request
+    ) -> None:
+        self._runtime_log_client(
+            writer,
+            "close",
+            meta={"request": request} | record.accounting(),
+        )
+        held = time.monotonic() - record.opened
+        self.stats.observe_duration(held)
+        if address is not None and self._top_sources is not None:
+            self._top_sources.add(address, held)
+
     async def __handler_common(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
     ):
-        async with self.sem:
+        accepted, address, source = self._open_client(writer)
+        if not accepted:
+            if self._config.over_limit == "hold":
+                await self._hold(reader)
+            writer.close()
+            return
+        record = ClientRecord(asyncio.current_task())
+        admitted = False
+        try:
+            admitted = await self._admit(record)
+        finally:
+            if source is not None and not admitted:
+                self._sources.release(source)
+        if not admitted:
+            self._reject(writer, "max_clients")
+            writer.close()
+            return
+        try:
             try:
-                tarpit_writer = TarpitWriter(128, writer=writer)
+                tarpit_writer = TarpitWriter(
+                    128,
+                    writer=writer,
+                    pacing=self._config.pacing,
+                    bucket=self._bucket,
+                    record=record,
+                    stall_timeout=self._config.stall_timeout,
+                    stats=self.stats,
+                )
                 tarpit_reader = TarpitReader(
                     1024, reader=reader
                 )  # TODO Add option
@@ -601,51 +2986,123 @@ class BaseTarpit:
                 ConnectionAbortedError,
                 ConnectionResetError,
             ) as e:
-                self._runtime_log_client(
-                    writer,
-                    "conn_error",
-                    meta={"err": e.__class__.__name__, "msg": str(e)},
-                )
+                self._conn_error(writer, e)
             except asyncio.exceptions.CancelledError:
                 self.logger.debug("task cancelled")
+            except TimeoutError as e:
+                if e.errno != errno.ETIMEDOUT:
+                    self.logger.exception(e)
+                else:
+                    self._conn_error(writer, e)
             except WindowsError as e:  # type: ignore
                 if e.winerror == 121:
-                    self._runtime_log_client(
-                        writer,
-                        "conn_error",
-                        meta={"err": e.__class__.__name__, "msg": str(e)},
-                    )
+                    self._conn_error(writer, e)
                 else:
                     self.logger.exception(e)
             except Exception as e:
                 self.logger.exception(e)
             finally:
-                self._runtime_log_client(
-                    writer, "close", meta={"request": tarpit_reader.dump_data()}
+                self._close_client(
+                    writer, record, address, tarpit_reader.dump_data()
                 )
+        finally:
+            self._release(record)
+            if source is not None:
+                self._sources.release(source)
+            writer.close()
+
+    def _protocol_factory(self) -> typing.Callable[[], asyncio.Protocol]:
+        """
+        Returns the protocol factory of the protocol backend.
+        """
+        handler = self.__handler_common
+        return lambda: TarpitProtocol(handler)
 
-    async def create_server(self, host, port, start_serving=False):
+    async def create_server(
+        self, host, port, start_serving=False, reuse_port=False
+    ):
         """
         Create a TCP server of this Tarpit and listen on the port of host address.
 
         Returns a asyncio.Server object.
 
+        Set reuse_port to bind with SO_REUSEPORT, so several worker
+        processes can listen on the same port.
+
         This function won't start the server immediately.
         The user should await on Server.start_serving() or
         Server.serve_forever() to make the server to start accepting connections.
         """
-        server = await asyncio.start_server(
-            self.__handler_common,
-            host=host,
-            port=port,
-            # limit=64,
-            # the buffer size of Stream reader, 64 byte
-            # by default will be 64 kb, too much since we do not read
-            # and the os kernel has it own buffer
-            # backlog=100,
-        )
+        loop = asyncio.get_running_loop()
+        if self._config.admission == "pause" and not self._can_pause(loop):
+            raise RuntimeError(
+                'admission "pause" needs the default selector event loop'
+            )
+        if self._config.backend == "protocol":
+            server = await loop.create_server(
+                self._protocol_factory(),
+                host=host,
+                port=port,
+                reuse_port=reuse_port or None,
+            )
+        else:
+            server = await asyncio.start_server(
+                self.__handler_common,
+                host=host,
+                port=port,
+                reuse_port=reuse_port or None,
+                # limit=64,
+                # the buffer size of Stream reader, 64 byte
+                # by default will be 64 kb, too much since we do not read
+                # and the os kernel has it own buffer
+                # backlog=100,
+            )
+        self._servers.append(server)
+        if self._config.analytics and self._summary_task is None:
+            self._summary_task = asyncio.create_task(self._log_summary())
         return server
 
+    def analytics_summary(self, n: int = 10) -> tuple[int, list]:
+        """
+        Returns the estimated number of unique sources, and the n sources
+        which held connections the longest as (address, seconds, error).
+        """
+        if self._unique_sources is None or self._top_sources is None:
+            return 0, []
+        top = [
+            (unpack_address(key), seconds, error)
+            for key, seconds, error in self._top_sources.top(n)
+        ]
+        return self._unique_sources.count(), top
+
+    async def _log_summary(self):
+        """
+        Logs the analytics summary every analytics_interval seconds, until
+        all servers of this tarpit are closed.
+        """
+        loop = asyncio.get_running_loop()
+        interval = self._config.analytics_interval
+
+        def log():
+            nonlocal handle
+            unique, top = self.analytics_summary()
+            self.logger.info(
+                "%s: ~%d unique sources, top sources by time held: %s",
+                self._config.name,
+                unique,
+                ", ".join("%s (%ds)" % (a, t) for a, t, _ in top) or "none",
+            )
+            handle = loop.call_later(interval, log)
+
+        handle = loop.call_later(interval, log)
+        try:
+            # Servers of other binds may be added meanwhile
+            while servers := [s for s in self._servers if s.sockets]:
+                await servers[0].wait_closed()
+        finally:
+            handle.cancel()
+            self._summary_task = None
+
     def __init__(self, **config) -> None:
         """
         Classes that inherit this class SHOULD NOT overload this method.
@@ -661,7 +3118,38 @@ class BaseTarpit:
             "server config: {}".format(self._config),
             dataclasses.asdict(self._config),
         )
-        self.sem = asyncio.Semaphore(self._config.max_clients)
+        # Admission control, shared by all binds of this tarpit
+        self._clients: dict[ClientRecord, None] = {}  # oldest first
+        self._waiters: collections.deque = collections.deque()
+        self._servers: list[asyncio.Server] = []
+        self._accept_callbacks: dict[int, tuple] = {}
+        self._paused = False
+        self.stats = TarpitStats()
+        self._socket_options = self._make_socket_options()
+        self._sources: SourceLimiter | None = None
+        self._unique_sources: HyperLogLog | None = None
+        self._top_sources: SpaceSaving | None = None
+        self._summary_task: asyncio.Task | None = None
+        if self._config.analytics:
+            self._unique_sources = HyperLogLog()
+            self._top_sources = SpaceSaving(self._config.analytics_top)
+        if self._config.max_clients_per_ip or (
+            self._config.max_clients_per_prefix
+        ):
+            self._sources = SourceLimiter(
+                self._config.max_clients_per_ip,
+                self._config.max_clients_per_prefix,
+                self._config.prefix_v4,
+                self._config.prefix_v6,
+            )
+        if self._config.bandwidth > 0:
+            self._bucket = TokenBucket(
+                self._config.bandwidth,
+                self._config.bandwidth_burst,
+                parent=TokenBucket.process_wide,
+            )
+        else:
+            self._bucket = TokenBucket.process_wide
 
         # Call setup for subclass setup
         self._setup()
@@ -703,6 +3191,8 @@ class StaticTarpit(BaseTarpit):
 
     _validator_support: int = 0
     _validator_config: ValidatorConfig
+    # Pass the reader to handle_client(), instead of draining it
+    _reads_request: bool = False
 
     async def _validate_client(self, reader, writer):
         conf = self._validator_config
@@ -719,7 +3209,10 @@ class StaticTarpit(BaseTarpit):
 
     async def __handle_valid_client(self, reader, tarpit_writer):
         tarpit_writer.change_rate_limit(self._config.rate_limit)
-        await self.handle_client(tarpit_writer)
+        if self._reads_request:
+            await self.handle_client(tarpit_writer, reader)
+        else:
+            await self.handle_client(tarpit_writer)
         await tarpit_writer.drain()
 
     async def __drain_remaining_data(self, reader: TarpitReader, writer):
@@ -737,17 +3230,27 @@ class StaticTarpit(BaseTarpit):
         )
         if result.expected:
             if result.data:  # result.data == None means skipped
+                self.stats.validation_passed += 1
                 self._runtime_log_client(
                     tarpit_writer, "validate", meta=result._asdict()
                 )
             tarpit_writer.change_rate_limit(self._config.rate_limit)
-            await asyncio.gather(  
-                # split read and write. we read and write at the same time.
-                # because we cant read after exception is raised.
-                self.__handle_valid_client(tarpit_reader, tarpit_writer),
-                self.__drain_remaining_data(tarpit_reader, tarpit_writer),
-            )
+            if self._reads_request:
+                if result.data:
+                    # The handler reads the request from its beginning
+                    tarpit_reader.unread(result.data)
+                await self.__handle_valid_client(tarpit_reader, tarpit_writer)
+            elif tarpit_reader.record_passively():
+                await self.__handle_valid_client(tarpit_reader, tarpit_writer)
+            else:
+                await asyncio.gather(
+                    # split read and write. we read and write at the same time.
+                    # because we cant read after exception is raised.
+                    self.__handle_valid_client(tarpit_reader, tarpit_writer),
+                    self.__drain_remaining_data(tarpit_reader, tarpit_writer),
+                )
         else:
+            self.stats.validation_failed += 1
             self._runtime_log_client(tarpit_writer, "validate", meta=result._asdict())
             await asyncio.sleep(random.randrange(16, 32))
         tarpit_writer.close()
@@ -772,8 +3275,39 @@ class StaticTarpit(BaseTarpit):
             self.__runtime_validate_client = self.__fake_validate_client
             pass
 
+    def stream(self) -> typing.Iterator[bytes | memoryview] | None:
+        """
+        Returns an iterator of the data sent to a valid client.
+
+        Patterns which have one are served by the default handle_client(),
+        and on the protocol backend, without a task (see StaticProtocol).
+        Returns None if the pattern needs its own handle_client(). (default)
+        """
+        return None
+
     async def handle_client(self, writer):
-        pass
+        stream = self.stream()
+        if stream is not None:
+            for chunk in stream:
+                await writer.write_and_drain(chunk)
+
+    def _protocol_factory(self):
+        conf = self._config
+        if (
+            self._reads_request
+            or self._bucket is not None
+            or conf.rate_limit != int(conf.rate_limit)
+            or conf.pacing not in ("userspace", "wheel")
+            or self.stream() is None
+        ):
+            return super()._protocol_factory()
+        validate = self.__runtime_validate_client == self._validate_client
+        if validate and (
+            type(self)._validate_client is not StaticTarpit._validate_client
+        ):
+            return super()._protocol_factory()  # Custom validation
+        return lambda: StaticProtocol(self, validate)
+
 
 class DynmanicTarpit(BaseTarpit):
     async def _handler(self, tarpit_reader, tarpit_writer):
@@ -815,12 +3349,96 @@ class EchoTarpit(DynmanicTarpit):
         # await writer.wait_closed()
 
 
+class LineStream:
+    """
+    An endless source of random lines, shared by the endless patterns.
+
+    Lines are made from a template with "%s" fields, each one filled with
+    8 random hex digits, so every line has the same length. RING bytes of
+    lines are generated once per template from os.urandom(), and shared
+    by all tarpits of the process. Clients start at a random line, and get
+    CHUNK-sized memoryview slices of the ring, so no Python work is done
+    per line.
+    """
+
+    RING: int = 1 << 18
+    CHUNK: int = 4096
+
+    _rings: dict[bytes, memoryview] = {}
+
+    @classmethod
+    def _make_ring(cls, template: bytes) -> memoryview:
+        fields = template.count(b"%s")
+        line_len = len(template) + fields * 6  # "%s" becomes 8 digits
+        lines = cls.RING // line_len
+        digits = os.urandom(4 * fields * lines).hex().encode()
+        values = [digits[i : i + 8] for i in range(0, len(digits), 8)]
+        ring = b"".join(
+            template % tuple(values[i : i + fields])
+            for i in range(0, len(values), fields)
+        )
+        return memoryview(ring)
+
+    def __init__(self, template: bytes) -> None:
+        ring = self._rings.get(template)
+        if ring is None:
+            ring = self._rings[template] = self._make_ring(template)
+        self._ring = ring
+        self.line_len = len(template) + template.count(b"%s") * 6
+        # Keep chunks on line boundaries
+        self.chunk = max(1, self.CHUNK // self.line_len) * self.line_len
+
+    def chunks(self) -> typing.Iterator[memoryview]:
+        """
+        Yields chunks of lines forever, starting at a random line.
+        """
+        ring = self._ring
+        pos = random.randrange(len(ring) // self.line_len) * self.line_len
+        while True:
+            end = min(pos + self.chunk, len(ring))
+            yield ring[pos:end]
+            pos = end % len(ring)
+
+
+class FramePool:
+    """
+    Prebuilt protocol frames, concatenated into batches of about BATCH
+    bytes, for patterns which send the same kind of frame forever.
+
+    The batches are built once at _setup. Clients start at a random batch
+    and send one whole batch per write.
+    """
+
+    BATCH: int = 4096
+    COUNT: int = 8
+
+    def __init__(self, frames: list[bytes]) -> None:
+        self._batches = []
+        for _ in range(self.COUNT):
+            batch = bytearray()
+            while len(batch) < self.BATCH:
+                batch += random.choice(frames)
+            self._batches.append(memoryview(bytes(batch)))
+
+    def batches(self) -> typing.Iterator[memoryview]:
+        """
+        Yields batches forever, starting at a random one.
+        """
+        index = random.randrange(len(self._batches))
+        while True:
+            yield self._batches[index]
+            index = (index + 1) % len(self._batches)
+
+
 class EndlessBannerTarpit(StaticTarpit):
     PATTERN_NAME: str = "endless_banner"
 
-    async def handle_client(self, writer: TarpitWriter):
-        while True:
-            await writer.write_and_drain(b"%x\r\n" % random.randint(0, 2**32))
+    def _setup(self):
+        super()._setup()
+        self._lines = LineStream(b"%s\r\n")
+
+    def stream(self):
+        return self._lines.chunks()
 
 
 class EgshAminoasTarpit(StaticTarpit):
@@ -838,11 +3456,11 @@ class EgshAminoasTarpit(StaticTarpit):
     _aminocese_cache: list = []
 
     # cSpell:enable
-    async def handle_client(self, writer: TarpitWriter):
+    def stream(self):
         while True:
             a = random.choice(self._aminocese_cache)
             header = a.encode() + b"\r\n"
-            await writer.write_and_drain(header)
+            yield header
             self.logger.info(a)
 
     def _setup(self):
@@ -857,11 +3475,92 @@ class EgshAminoasTarpit(StaticTarpit):
 class HttpTarpit(StaticTarpit):
     _validator_support = 1
 
+    @dataclasses.dataclass
+    class RuntimeConfig(StaticTarpit.RuntimeConfig):
+        keep_alive: bool = False
+        max_requests: int = 64
+
     @dataclasses.dataclass
     class ValidatorConfig(StaticTarpit.ValidatorConfig):
         head_allowlist = [b"GET ", b"HEAD"]
 
+    SERVER_HEADERS: bytes = (
+        b"Server: Apache/2.4.9\r\nX-Powered-By: PHP/5.1.2-1+b1\r\n"
+    )
+
+    @staticmethod
+    def make_status_line(code: int, version: bytes = b"HTTP/1.1") -> bytes:
+        status = http.HTTPStatus(code)
+        return b"%s %d %s\r\n" % (
+            version,
+            status,
+            bytes(status.phrase, "ASCII"),
+        )
+
+    @classmethod
+    def make_response_head(
+        cls,
+        code: int,
+        length: int,
+        headers: typing.Iterable[tuple[bytes, bytes]] = (),
+        type_: bytes = b"",
+        encoding: bytes = b"",
+    ) -> bytes:
+        """
+        Returns the status line and headers of a response with a body of
+        "length" bytes, the same bytes Connection would send.
+        """
+        lines = [cls.make_status_line(code), cls.SERVER_HEADERS]
+        for keyword, value in headers:
+            lines.append(b"%s: %s\r\n" % (keyword, value))
+        lines.append(
+            b"Content-Type: %s\r\n" % (type_ or b"text/html; charset=UTF-8")
+        )
+        lines.append(b"Content-Length: %d\r\n" % length)
+        if encoding:
+            lines.append(b"Content-Encoding: %s\r\n" % encoding)
+        lines.append(b"\r\n")
+        return b"".join(lines)
+
+    class Request(typing.NamedTuple):
+        method: bytes
+        target: bytes
+        version: bytes
+        headers: dict[bytes, bytes]
+        keep_alive: bool
+
+        @classmethod
+        def parse(cls, head: bytes) -> "HttpTarpit.Request | None":
+            """
+            Parses the head of a request, without the empty line.
+
+            Header names are lowercased. Requests with a body are never
+            kept alive, as their body is not read, neither are HEAD
+            requests, as the body is sent anyway.
+            """
+            line, *lines = head.split(b"\r\n")
+            parts = line.split(b" ")
+            if len(parts) != 3 or not parts[2].startswith(b"HTTP/"):
+                return None
+            headers = {}
+            for i in lines:
+                name, colon, value = i.partition(b":")
+                if colon:
+                    headers[name.strip().lower()] = value.strip()
+            keep_alive = (
+                parts[2] == b"HTTP/1.1"
+                and parts[0] != b"HEAD"
+                and headers.get(b"connection", b"").lower() != b"close"
+                and headers.get(b"content-length", b"0") == b"0"
+                and b"transfer-encoding" not in headers
+            )
+            return cls(*parts, headers, keep_alive)
+
     class Connection:
+        # Limits for reading the head of a request
+        MAX_HEAD: int = 8192
+        HEAD_TIMEOUT: float = 10
+
         @staticmethod
         def to_bytes(data) -> bytes:
             t = type(data)
@@ -877,14 +3576,10 @@ class HttpTarpit(StaticTarpit):
         async def send_status_line(
             self, code: int, version: bytes = b"HTTP/1.1"
         ):
-            status = http.HTTPStatus(code)
             await self.writer.write_and_drain(
-                b"%s %d %s\r\n"
-                % (version, status, bytes(status.phrase, "ASCII"))
-            )
-            await self.send_raw(
-                b"Server: Apache/2.4.9\r\nX-Powered-By: PHP/5.1.2-1+b1\r\n"
+                HttpTarpit.make_status_line(code, version)
             )
+            await self.send_raw(HttpTarpit.SERVER_HEADERS)
             # Note: There should be a Date header
             #       But we just omit it
             # https://www.rfc-editor.org/rfc/rfc9110.html
@@ -922,87 +3617,481 @@ class HttpTarpit(StaticTarpit):
             await self.send_raw(content)
             pass
 
-        def __init__(self, writer: TarpitWriter) -> None:
+        async def read_request(self) -> "HttpTarpit.Request | None":
+            """
+            Reads the head of the next request, at most MAX_HEAD bytes.
+
+            Pipelined requests stay in the buffer for the next call, and
+            only the new data is searched for the end of the head.
+
+            Returns None if the tarpit does not read requests, or the
+            client sent no valid request in time.
+            """
+            if self.reader is None:
+                return None
+            buffer = self._buffer
+            start = 0
+            try:
+                async with asyncio.timeout(self.HEAD_TIMEOUT):
+                    while True:
+                        # Empty lines before a request should be ignored
+                        while buffer[:2] == b"\r\n":
+                            del buffer[:2]
+                        end = buffer.find(b"\r\n\r\n", start)
+                        if end >= 0:
+                            break
+                        if len(buffer) >= self.MAX_HEAD:
+                            return None
+                        start = max(0, len(buffer) - 3)
+                        data = await self.reader.read(
+                            self.MAX_HEAD - len(buffer)
+                        )
+                        if not data:
+                            return None
+                        buffer += data
+            except TimeoutError:
+                return None
+            head = bytes(buffer[:end])
+            del buffer[: end + 4]
+            return HttpTarpit.Request.parse(head)
+
+        def __init__(self, writer: TarpitWriter, reader=None) -> None:
             self.writer = writer
+            self.reader = reader
             self.send_raw = writer.write_and_drain
+            self.request: HttpTarpit.Request | None = None
+            self._buffer = bytearray()
             pass
 
         pass
 
+    def _http_stream(self) -> typing.Iterator[bytes | memoryview] | None:
+        """
+        Returns an iterator of the whole response, for patterns which
+        send the same kind of response whatever the request is.
+
+        See StaticTarpit.stream(). Patterns which return None (default)
+        overload _http_handler().
+        """
+        return None
+
     async def _http_handler(self, connection: Connection):
-        pass
+        stream = self._http_stream()
+        if stream is not None:
+            for chunk in stream:
+                await connection.send_raw(chunk)
 
-    async def handle_client(self, writer: TarpitWriter):
-        conn = HttpTarpit.Connection(writer)
-        await self._http_handler(conn)
-        pass
+    def stream(self):
+        if self._reads_request:
+            return None  # The response depends on the request
+        return self._http_stream()
+
+    def _setup(self):
+        super()._setup()
+        config: HttpTarpit.RuntimeConfig = self._config  # type: ignore
+        if config.max_requests < 1:
+            raise ValueError("max_requests must be at least 1")
+        if config.keep_alive:
+            self._reads_request = True
+
+    async def handle_client(self, writer: TarpitWriter, reader=None):
+        conn = HttpTarpit.Connection(writer, reader)
+        if reader is None:
+            await self._http_handler(conn)
+            return
+        # Serve requests one after another, with keep_alive, until the
+        # client stops sending or max_requests are served
+        config: HttpTarpit.RuntimeConfig = self._config  # type: ignore
+        for served in range(config.max_requests):
+            request = await conn.read_request()
+            if request is None and served:
+                break
+            # The first one is served even if it is not a valid request
+            conn.request = request
+            await self._http_handler(conn)
+            if not (config.keep_alive and request and request.keep_alive):
+                break
 
     pass
 
 
-class HttpOkTarpit(HttpTarpit):
-    PATTERN_NAME: str = "_internal_http_ok"
+class HttpOkTarpit(HttpTarpit):
+    PATTERN_NAME: str = "_internal_http_ok"
+
+    async def _http_handler(self, connection):
+        await connection.send_status_line(200)
+        await connection.send_content(b"DUCK!")
+        # Left close to wrapped handler
+        # await connection.close()
+
+
+class HttpFakeAuthTarpit(HttpTarpit):
+    PATTERN_NAME: str = "http_fake_auth"
+
+    def _setup(self):
+        super()._setup()
+        content = b"401 Unauthorized"
+        self._response_image = self.make_response_head(
+            401,
+            len(content),
+            headers=[(b"WWW-Authenticate", b'Basic realm="Server"')],
+        ) + content
+
+    def _http_stream(self):
+        return iter((self._response_image,))
+
+
+class HttpEndlessHeaderTarpit(HttpTarpit):
+    PATTERN_NAME: str = "http_endless_header"
+
+    def _setup(self):
+        super()._setup()
+        self._lines = LineStream(b"Set-Cookie: %s=%s\r\n")
+
+    def _http_stream(self):
+        yield self.make_status_line(200) + self.SERVER_HEADERS
+        yield from self._lines.chunks()
+
+
+class ContentCache:
+    """
+    A content-addressed cache of pregenerated payloads on disk.
+
+    Files are named after a hash of the key, which includes everything that
+    affects the generated output. Cached payloads are mapped with mmap, so
+    all tarpits (and all worker processes) serving the same payload share
+    the same page-cache memory.
+
+    Disabled unless "directory" is set.
+    """
+
+    VERSION: int = 2
+    directory: str | None = None
+
+    @classmethod
+    def _path(cls, key: tuple) -> str:
+        assert cls.directory
+        digest = hashlib.sha256(repr((cls.VERSION, key)).encode()).hexdigest()
+        return os.path.join(cls.directory, digest + ".bin")
+
+    @classmethod
+    def load(
+        cls, key: tuple
+    ) -> tuple[dict, memoryview, typing.BinaryIO, int] | None:
+        """
+        Returns the metadata and a read-only view of the payload, with the
+        open cache file and the offset of the payload in it, or None if
+        it is not cached.
+
+        The caller owns the file, it can be registered to StaticBuffer
+        together with the view, so the payload is sent from the page
+        cache with sendfile().
+        """
+        if not cls.directory:
+            return None
+        path = cls._path(key)
+        try:
+            file = open(path, "rb", buffering=0)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning("failed to load cached content %s: %s", path, e)
+            return None
+        try:
+            data = memoryview(
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+        except (OSError, ValueError) as e:
+            file.close()
+            logging.warning("failed to load cached content %s: %s", path, e)
+            return None
+        head_len = bytes(data[:1024]).find(b"\n")
+        try:
+            meta = json.loads(bytes(data[:head_len]))
+        except ValueError:
+            file.close()
+            logging.warning("ignore broken cached content %s", path)
+            return None
+        logging.debug("loaded cached content %s", path)
+        return meta, data[head_len + 1 :], file, head_len + 1
+
+    @classmethod
+    def store(cls, key: tuple, meta: dict, data) -> None:
+        if not cls.directory:
+            return
+        path = cls._path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            os.makedirs(cls.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta).encode() + b"\n")
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("failed to save content to cache: %s", e)
+            return
+        logging.debug("saved content to cache %s", path)
+
+
+def generate_content(tarpit_class, config: dict):
+    """
+    Runs _generate_content() of tarpit_class with config, in a process of
+    the pool of ContentJobs. The tarpit is not set up, only its config, so
+    _generate_content() must not use anything made by _setup().
+    """
+    pit = object.__new__(tarpit_class)
+    pit.logger = logging.getLogger(__name__)
+    pit._config = tarpit_class.RuntimeConfig()
+    pit._config.update_from_dict(config)
+    return pit._generate_content()
+
+
+class ContentJobs:
+    """
+    Generates the content of HttpPreGeneratedTarpit in a process pool, so
+    slow content of several tarpits is generated at the same time, and
+    tarpits which do not need generated content can start serving without
+    waiting for it.
+
+    Jobs are deduplicated by their content key, tarpits with the same key
+    share the same job.
+
+    Disabled unless "pool" is set, then content which is not in the
+    ContentCache is declared as a job instead of being generated in
+    _setup().
+    """
+
+    pool: concurrent.futures.Executor | None = None
+    _jobs: dict[tuple, concurrent.futures.Future] = {}
+
+    @classmethod
+    def start(cls) -> None:
+        if "fork" in multiprocessing.get_all_start_methods():
+            # No need to import the tarpit classes again in the children
+            context = multiprocessing.get_context("fork")
+        else:
+            context = None
+        cls.pool = concurrent.futures.ProcessPoolExecutor(mp_context=context)
+
+    @classmethod
+    def submit(
+        cls, key: tuple | None, tarpit_class, config: dict
+    ) -> concurrent.futures.Future:
+        assert cls.pool
+        if key is not None and key in cls._jobs:
+            return cls._jobs[key]
+        job = cls.pool.submit(generate_content, tarpit_class, config)
+        if key is not None:
+            cls._jobs[key] = job
+        return job
+
+    @classmethod
+    def close(cls, wait: bool = False) -> None:
+        """
+        Accept no more jobs, the declared ones keep running unless wait.
+        """
+        if cls.pool is not None:
+            cls.pool.shutdown(wait=wait)
+        cls.pool = None
+        cls._jobs = {}
 
-    async def _http_handler(self, connection):
-        await connection.send_status_line(200)
-        await connection.send_content(b"DUCK!")
-        # Left close to wrapped handler
-        # await connection.close()
 
+class ContentRegistry:
+    """
+    Response images of HttpPreGeneratedTarpit in this process, shared by
+    all tarpits with the same content key, so every distinct payload is
+    generated and kept in memory once.
 
-class HttpFakeAuthTarpit(HttpTarpit):
-    PATTERN_NAME: str = "http_fake_auth"
+    Entries are reference counted, and freed with their StaticBuffer once
+    the last tarpit using them is gone.
+    """
 
-    async def _http_handler(self, connection):
-        await connection.send_status_line(401)
-        await connection.send_header(
-            b"WWW-Authenticate", b'Basic realm="Server"'
-        )
-        await connection.send_content(b"401 Unauthorized")
+    _entries: dict[tuple, tuple] = {}
+    _refs: dict[tuple, int] = {}
 
+    @classmethod
+    def acquire(cls, key: tuple) -> tuple | None:
+        """
+        Returns the entry of key and takes a reference, or None.
+        """
+        entry = cls._entries.get(key)
+        if entry is not None:
+            cls._refs[key] += 1
+        return entry
 
-class HttpEndlessHeaderTarpit(HttpTarpit):
-    PATTERN_NAME: str = "http_endless_header"
+    @classmethod
+    def add(cls, key: tuple, entry: tuple) -> None:
+        assert key not in cls._entries
+        cls._entries[key] = entry
+        cls._refs[key] = 1
 
-    async def _http_handler(self, connection):
-        await connection.send_status_line(200)
-        while True:
-            header = b"Set-Cookie: "
-            await connection.send_raw(header)
-            header = b"%x=%x\r\n" % (
-                random.randint(0, 2**32),
-                random.randint(0, 2**32),
-            )
-            await connection.send_raw(header)
+    @classmethod
+    def release(cls, key: tuple) -> None:
+        cls._refs[key] -= 1
+        if not cls._refs[key]:
+            del cls._refs[key]
+            _, buffer_id, _ = cls._entries.pop(key)
+            StaticBuffer.release(buffer_id)
 
 
 class HttpPreGeneratedTarpit(HttpTarpit):
+    # Content with a key is also saved to the ContentCache, not only
+    # shared by the tarpits of this process
+    CACHE_CONTENT: bool = True
+
     @dataclasses.dataclass
     class RuntimeConfig(HttpTarpit.RuntimeConfig):
         rate_limit: int = 128
         pass
 
     class Content(typing.NamedTuple):
-        data: bytes
+        data: bytes | memoryview
         type_: str = ""
         encoding: str = ""
         pass
 
     async def _http_handler(self, connection: HttpTarpit.Connection):
-        await connection.send_status_line(200)
-        await connection.send_content(
-            content=self._content_generated.data,
-            type_=self._content_generated.type_.encode("ASCII"),
-            encoding=self._content_generated.encoding.encode("ASCII"),
-        )
+        await connection.writer.send_static(self._response_id)
+
+    def _http_stream(self):
+        if self._config.rate_limit == 0:
+            return None  # Sent with sendfile() from _http_handler()
+        return iter((self._response_image,))
 
     def _setup(self):
+        """
+        Generate the content (or load it from the cache), and compile the
+        whole response into one immutable buffer, the response image.
+
+        If ContentJobs is enabled, the content is generated there, and the
+        tarpit starts listening once it is done.
+        """
         super()._setup()
-        self._content_generated = self._generate_content()
+        self._check_content_config()
+        self._content_job: concurrent.futures.Future | None = None
+        key = self._content_key()
+        if key is not None and self._use_shared(key):
+            return
+        cached = None
+        if key is not None and self.CACHE_CONTENT:
+            cached = ContentCache.load(key)
+        if cached is not None:
+            self._install_image(key, *cached)
+        elif ContentJobs.pool is not None:
+            self._content_job = ContentJobs.submit(
+                key, type(self), dict(vars(self._config))
+            )
+        else:
+            self._install_content(key, self._generate_content())
+
+    def _use_shared(self, key: tuple) -> bool:
+        entry = ContentRegistry.acquire(key)
+        if entry is None:
+            return False
+        weakref.finalize(self, ContentRegistry.release, key)
+        self._response_image, self._response_id, self._content_generated = (
+            entry
+        )
+        return True
+
+    def _install_content(self, key: tuple | None, content: Content):
+        # Another tarpit may have been waiting for the same job
+        if key is not None and self._use_shared(key):
+            return
+        head = self._make_response_head(content)
+        meta = {
+            "type_": content.type_,
+            "encoding": content.encoding,
+            "head": len(head),
+        }
+        image = head + content.data
+        del content
+        cached = None
+        if key is not None and self.CACHE_CONTENT:
+            ContentCache.store(key, meta, image)
+            # Serve from the cache, so the memory is shared
+            cached = ContentCache.load(key)
+        if cached is None:
+            cached = meta, memoryview(image)
+        self._install_image(key, *cached)
+
+    def _install_image(
+        self,
+        key: tuple | None,
+        meta: dict,
+        image: memoryview,
+        file: typing.BinaryIO | None = None,
+        offset: int = 0,
+    ):
+        """
+        Serve image, the whole response. If it was loaded from the
+        ContentCache, it is sent from the cache file, not copied to a
+        memfd.
+        """
+        head_len = meta.pop("head")
+        self._response_image = image
+        self._response_id = StaticBuffer.register(image, file, offset)
+        self._content_generated = self.Content(image[head_len:], **meta)
+        if key is not None:
+            ContentRegistry.add(
+                key,
+                (image, self._response_id, self._content_generated),
+            )
+            weakref.finalize(self, ContentRegistry.release, key)
+
+    def wait_content(self):
+        """
+        Block until the content declared to ContentJobs is generated.
+        """
+        if self._content_job is not None:
+            job, self._content_job = self._content_job, None
+            self._install_content(self._content_key(), job.result())
+
+    async def create_server(self, host, port, *args, **kwargs):
+        if self._content_job is not None:
+            job = self._content_job
+            content = await asyncio.wrap_future(job)
+            # Several binds may be waiting for the same job
+            if self._content_job is job:
+                self._content_job = None
+                self._install_content(self._content_key(), content)
+        return await super().create_server(host, port, *args, **kwargs)
+
+    def _make_response_head(self, content: Content) -> bytes:
+        """
+        Returns the status line and headers sent before content.
+        """
+        return self.make_response_head(
+            200,
+            len(content.data),
+            type_=content.type_.encode("ASCII"),
+            encoding=content.encoding.encode("ASCII"),
+        )
+
+    def _content_key(self) -> tuple | None:
+        """
+        Returns a key identifying the output of _generate_content(), it
+        must include every parameter affecting the output.
+
+        Returns None if the content should not be shared or cached.
+        (default) Set CACHE_CONTENT to share it without caching.
+        """
+        return None
+
+    def _check_content_config(self) -> None:
+        """
+        Raises ValueError if _generate_content() can not work with the
+        config. Called by _setup(), so a bad config fails at startup, and
+        not later in ContentJobs.
+        """
+        return
 
     def _generate_content(self) -> Content:
         """
         Subclass should overload this method
+
+        It may run in another process, with only the config set, see
+        generate_content().
         """
         raise NotImplementedError
 
@@ -1010,7 +4099,25 @@ class HttpPreGeneratedTarpit(HttpTarpit):
 
 
 class HttpBadHtmlTarpit(HttpPreGeneratedTarpit):
+    """
+    A page of links and a dead-loop script.
+
+    In maze mode, the page of every path is derived from a keyed hash of
+    the path, so crawlers find an endless graph of pages, and the same
+    path always gets the same page. Only maze_cache recent pages are
+    kept, nothing is stored per crawler.
+    """
+
     PATTERN_NAME = "http_bad_site"
+
+    @dataclasses.dataclass
+    class RuntimeConfig(HttpPreGeneratedTarpit.RuntimeConfig):
+        maze: bool = False
+        maze_cache: int = 256
+
+    LINKS: int = 300
+    # Only hash the path up to this length
+    MAX_PATH: int = 1024
     # const WORKERS = 4, SAMPLES_PER = 1e10;
     # const wSrc = `
     # self.onmessage = e => {
@@ -1059,22 +4166,68 @@ class HttpBadHtmlTarpit(HttpPreGeneratedTarpit):
         b"x123279);}"
     )
 
-    def _generate_content(self):
-        data = bytearray()
+    _PAGE_TEMPLATE = (
+        b"<!DOCTYPE html><html><body><script>%s</script>"
+        % _BAD_SCRIPT.replace(b"%", b"%%")
+        + b"<div id='%s'>SUPER<a href='/%s.html'>HOT</a>" * LINKS
+        + b"</div>" * LINKS
+    )
 
-        data.extend(
-            b"<!DOCTYPE html><html><body><script>%s</script>"
-            % (self._BAD_SCRIPT)
+    def _setup(self):
+        super()._setup()
+        if self._config.maze:  # pytype: disable=attribute-error
+            self._reads_request = True
+        # Generated once, workers forked later share the same maze
+        self._maze_key = os.urandom(32)
+        self._maze_pages: collections.OrderedDict[bytes, bytes] = (
+            collections.OrderedDict()
         )
 
-        for i in range(300):
-            data.extend(
-                b"<div id='%x'>SUPER<a href='/%x.html'>HOT</a>"
-                % (random.randint(0, 2**32), random.randint(0, 2**32))
-            )
-        for i in range(300):
-            data.extend(b"</div>")
+    def _make_page(self, seed: bytes) -> bytes:
+        """
+        Returns the page filled with 8 hex digits per field, drawn from
+        a random generator seeded with seed.
+        """
+        digits = random.Random(seed).randbytes(8 * self.LINKS).hex().encode()
+        return self._PAGE_TEMPLATE % tuple(
+            digits[i : i + 8] for i in range(0, len(digits), 8)
+        )
+
+    def maze_response(self, target: bytes) -> bytes:
+        """
+        Returns the whole response for the path of target.
+        """
+        path = target.partition(b"?")[0][: self.MAX_PATH]
+        pages = self._maze_pages
+        response = pages.get(path)
+        if response is not None:
+            pages.move_to_end(path)
+            return response
+        seed = hashlib.blake2b(path, key=self._maze_key).digest()
+        page = self._make_page(seed)
+        response = self.make_response_head(200, len(page)) + page
+        pages[path] = response
+        if len(pages) > self._config.maze_cache:
+            pages.popitem(last=False)
+        return response
+
+    async def _http_handler(self, connection: HttpTarpit.Connection):
+        if not self._config.maze or connection.request is None:
+            await super()._http_handler(connection)
+            return
+        await connection.send_raw(
+            self.maze_response(connection.request.target)
+        )
 
+    # Random, a new page on every start
+    CACHE_CONTENT = False
+
+    def _content_key(self):
+        # But the same page can be shared by every instance
+        return (self.PATTERN_NAME, type(self).__qualname__)
+
+    def _generate_content(self):
+        data = self._make_page(os.urandom(32))
         self.logger.debug("generated bad html %i kb", len(data) / 1024)
         return self.Content(data)
 
@@ -1091,6 +4244,19 @@ class HttpDeflateTarpit(HttpPreGeneratedTarpit):
     def _make_deflate(self, compressobj):
         raise NotImplementedError
 
+    def _check_content_config(self):
+        config = self._config
+        encoding = config.compression_type  # pytype: disable=attribute-error
+        if encoding not in ("gzip", "deflate"):
+            raise ValueError("unknown compression_type: " + encoding)
+
+    def _content_key(self):
+        return (
+            self.PATTERN_NAME,
+            type(self).__qualname__,
+            self._config.compression_type,  # pytype: disable=attribute-error
+        )
+
     def _generate_content(self):
         self._deflate_content = b""
         self.compression_type = (
@@ -1158,6 +4324,247 @@ class HttpDeflateHtmlBombTarpit(HttpDeflateTarpit):
         self.logger.info(f"deflate bomb created:{int(len(bomb) / 1024):d} kb")
 
 
+def adler32_zeros(adler: int, n: int) -> int:
+    """
+    Returns the Adler-32 of the data checksummed by "adler", followed by
+    n zero bytes, without going through the zeroes.
+    """
+    a, b = adler & 0xFFFF, adler >> 16
+    # Zeroes leave "a" as it is, and add "a" to "b" for every byte
+    return (((b + n * a) % 65521) << 16) | a
+
+
+def crc32_zeros(crc: int, n: int) -> int:
+    """
+    Returns the CRC-32 of the data checksummed by "crc", followed by n
+    zero bytes, in O(log n) steps. Same method as crc32_combine() of zlib:
+    appending zeroes is a linear operator over GF(2), squared for every
+    bit of n.
+    """
+
+    def times(matrix, vector):
+        total = 0
+        for row in matrix:
+            if not vector:
+                break
+            if vector & 1:
+                total ^= row
+            vector >>= 1
+        return total
+
+    def square(matrix):
+        return [times(matrix, row) for row in matrix]
+
+    # Operator for one zero bit, then for one zero byte
+    operator = [0xEDB88320] + [1 << i for i in range(31)]
+    for _ in range(3):
+        operator = square(operator)
+    register = crc ^ 0xFFFFFFFF
+    while n:
+        if n & 1:
+            register = times(operator, register)
+        n >>= 1
+        if n:
+            operator = square(operator)
+    return register ^ 0xFFFFFFFF
+
+
+class HttpNestedDeflateBombTarpit(HttpDeflateTarpit):
+    """
+    A deflate bomb compressed again, sent with stacked Content-Encoding
+    like "deflate, gzip".
+
+    The inner layer is made of one block of compressed zeroes repeated
+    many times, which is itself very repetitive, so the outer layer
+    compresses it by about 1000:1 again. The inner layer is never built
+    in memory: its blocks are fed to the outer compressor one by one, and
+    its checksum is computed without going through the zeroes.
+    """
+
+    PATTERN_NAME: str = "http_nested_deflate_bomb"
+
+    # Zeroes in one inner block, and how many times it is repeated
+    BLOCK_SIZE: int = 16 * 1024**2
+    BLOCKS: int = 1024
+
+    @dataclasses.dataclass
+    class RuntimeConfig(HttpTarpit.RuntimeConfig):
+        rate_limit = 16
+        compression_type = "deflate, gzip"
+        pass
+
+    WBITS = {"deflate": 15, "gzip": 31}
+
+    def _inner_layer(self, encoding: str) -> typing.Iterator[bytes]:
+        """
+        Yields the parts of the innermost layer, a stream of
+        BLOCK_SIZE * BLOCKS zeroes wrapped in some invalid HTML.
+        """
+        prefix, suffix = b"<html>MORE!</dd>" * 5, b"</html>MORE!</dd>" * 5
+        raw = zlib.compressobj(level=9, wbits=-15)
+        start = raw.compress(prefix) + raw.flush(zlib.Z_FULL_FLUSH)
+        # Self-contained after a full flush, so it can be repeated
+        block = raw.compress(bytes(self.BLOCK_SIZE))
+        block += raw.flush(zlib.Z_FULL_FLUSH)
+        end = raw.compress(suffix) + raw.flush()
+        size = len(prefix) + self.BLOCK_SIZE * self.BLOCKS + len(suffix)
+        if encoding == "gzip":
+            yield b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff"
+            crc = crc32_zeros(zlib.crc32(prefix), self.BLOCK_SIZE * self.BLOCKS)
+            trailer = struct.pack(
+                "<II", zlib.crc32(suffix, crc), size & 0xFFFFFFFF
+            )
+        else:
+            yield b"\x78\xda"
+            adler = adler32_zeros(
+                zlib.adler32(prefix), self.BLOCK_SIZE * self.BLOCKS
+            )
+            trailer = struct.pack(">I", zlib.adler32(suffix, adler))
+        yield start
+        for _ in range(self.BLOCKS):
+            yield block
+        yield end
+        yield trailer
+
+    def _content_key(self):
+        return (
+            self.PATTERN_NAME,
+            type(self).__qualname__,
+            self._config.compression_type,  # pytype: disable=attribute-error
+            self.BLOCK_SIZE,
+            self.BLOCKS,
+        )
+
+    def _layers(self) -> list[str]:
+        config = self._config
+        encodings = config.compression_type  # pytype: disable=attribute-error
+        return [i.strip() for i in encodings.split(",")]
+
+    def _check_content_config(self):
+        for encoding in self._layers():
+            if encoding not in self.WBITS:
+                raise ValueError("unknown compression_type: " + encoding)
+
+    def _generate_content(self):
+        layers = self._layers()
+        self.logger.info("creating nested bomb...")
+        parts: typing.Iterable[bytes] = self._inner_layer(layers[0])
+        for encoding in layers[1:]:
+            compressobj = zlib.compressobj(level=9, wbits=self.WBITS[encoding])
+            layer = bytearray()
+            for part in parts:
+                layer += compressobj.compress(part)
+            layer += compressobj.flush()
+            parts = [bytes(layer)]
+        bomb = b"".join(parts)
+        self.logger.info(
+            "nested bomb created: %d kb for %d mb",
+            len(bomb) // 1024,
+            self.BLOCK_SIZE * self.BLOCKS // 1024**2,
+        )
+        return self.Content(data=bomb, encoding=", ".join(layers))
+
+
+class HttpDeflateStreamBombTarpit(HttpPreGeneratedTarpit):
+    """
+    An endless deflate stream with chunked transfer encoding.
+
+    After a full flush, deflate blocks do not refer to earlier data, so
+    one flushed block of compressed zeroes can be repeated forever in the
+    same stream. The content is the start of the stream and the block,
+    each one framed as a chunk. Every client gets the whole response
+    image once, then its block again and again. The stream never ends, so
+    neither does the decompression.
+    """
+
+    PATTERN_NAME: str = "http_deflate_stream_bomb"
+
+    # Zeroes in one repeated block, about 16 KB after compression
+    BLOCK_SIZE: int = 16 * 1024**2
+
+    @dataclasses.dataclass
+    class RuntimeConfig(HttpPreGeneratedTarpit.RuntimeConfig):
+        rate_limit: int = 1024
+        compression_type: str = "gzip"
+        pass
+
+    @staticmethod
+    def make_chunk(data) -> bytes:
+        return b"%x\r\n%s\r\n" % (len(data), data)
+
+    def _content_key(self):
+        return (
+            self.PATTERN_NAME,
+            type(self).__qualname__,
+            self._config.compression_type,  # pytype: disable=attribute-error
+            self.BLOCK_SIZE,
+        )
+
+    def _check_content_config(self):
+        config = self._config
+        encoding = config.compression_type  # pytype: disable=attribute-error
+        if encoding not in ("gzip", "deflate"):
+            raise ValueError("unknown compression_type: " + encoding)
+
+    def _generate_content(self):
+        config = self._config
+        encoding = config.compression_type  # pytype: disable=attribute-error
+        match encoding:
+            case "gzip":
+                compressobj = zlib.compressobj(level=9, wbits=31)
+            case "deflate":
+                compressobj = zlib.compressobj(level=9, wbits=15)
+        start = compressobj.compress(b"<html>MORE!</dd>" * 5)
+        start += compressobj.flush(zlib.Z_FULL_FLUSH)
+        block = compressobj.compress(bytes(self.BLOCK_SIZE))
+        block += compressobj.flush(zlib.Z_FULL_FLUSH)
+        self.logger.info(
+            "stream bomb block created: %d kb for %d mb",
+            len(block) // 1024,
+            self.BLOCK_SIZE // 1024**2,
+        )
+        return self.Content(
+            self.make_chunk(start) + self.make_chunk(block), encoding=encoding
+        )
+
+    def _make_response_head(self, content):
+        return (
+            self.make_status_line(200)
+            + self.SERVER_HEADERS
+            + b"Content-Type: text/html; charset=UTF-8\r\n"
+            + b"Content-Encoding: %s\r\n" % content.encoding.encode("ASCII")
+            + b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+
+    def _block_offset(self) -> int:
+        """
+        Returns the offset of the repeated block in the response image.
+        """
+        data = self._content_generated.data
+        size_end = bytes(data[:16]).index(b"\r\n")
+        start_chunk = size_end + 2 + int(bytes(data[:size_end]), 16) + 2
+        return len(self._response_image) - len(data) + start_chunk
+
+    async def _http_handler(self, connection: HttpTarpit.Connection):
+        offset = self._block_offset()
+        await connection.writer.send_static(self._response_id, 0, offset)
+        while True:
+            await connection.writer.send_static(self._response_id, offset)
+
+    def _http_stream(self):
+        if self._config.rate_limit == 0:
+            return None  # Sent with sendfile() from _http_handler()
+        return self._bomb_stream()
+
+    def _bomb_stream(self):
+        offset = self._block_offset()
+        image = self._response_image
+        yield image[:offset]
+        block = image[offset:]
+        while True:
+            yield block
+
+
 #
 # SSH
 #
@@ -1214,66 +4621,60 @@ class SshTarpit(StaticTarpit):
 class SshTransHoldTarpit(SshTarpit):
     PATTERN_NAME: str = "ssh_trans_hold"
 
-    @property
-    def OPENSSH_KEX(self):
-        """
-        Hard-coded Key Exchange Init message
-        from a OpenSSH 9.5 client.
-
-        It can be used in server,
-        because server and client uses the same format.
-        """
-        return bytes.fromhex(
-            "1417a3abdb8fa4d9ba63aea67651cbc85b00000114736e747275703736317832"
-            "353531392d736861353132406f70656e7373682e636f6d2c6375727665323535"
-            "31392d7368613235362c637572766532353531392d736861323536406c696273"
-            "73682e6f72672c656364682d736861322d6e697374703235362c656364682d73"
-            "6861322d6e697374703338342c656364682d736861322d6e697374703532312c"
-            "6469666669652d68656c6c6d616e2d67726f75702d65786368616e67652d7368"
-            "613235362c6469666669652d68656c6c6d616e2d67726f757031362d73686135"
-            "31322c6469666669652d68656c6c6d616e2d67726f757031382d736861353132"
-            "2c6469666669652d68656c6c6d616e2d67726f757031342d7368613235362c65"
-            "78742d696e666f2d63000001cf7373682d656432353531392d636572742d7630"
-            "31406f70656e7373682e636f6d2c65636473612d736861322d6e697374703235"
-            "362d636572742d763031406f70656e7373682e636f6d2c65636473612d736861"
-            "322d6e697374703338342d636572742d763031406f70656e7373682e636f6d2c"
-            "65636473612d736861322d6e697374703532312d636572742d763031406f7065"
-            "6e7373682e636f6d2c736b2d7373682d656432353531392d636572742d763031"
-            "406f70656e7373682e636f6d2c736b2d65636473612d736861322d6e69737470"
-            "3235362d636572742d763031406f70656e7373682e636f6d2c7273612d736861"
-            "322d3531322d636572742d763031406f70656e7373682e636f6d2c7273612d73"
-            "6861322d3235362d636572742d763031406f70656e7373682e636f6d2c737368"
-            "2d656432353531392c65636473612d736861322d6e697374703235362c656364"
-            "73612d736861322d6e697374703338342c65636473612d736861322d6e697374"
-            "703532312c736b2d7373682d65643235353139406f70656e7373682e636f6d2c"
-            "736b2d65636473612d736861322d6e69737470323536406f70656e7373682e63"
-            "6f6d2c7273612d736861322d3531322c7273612d736861322d3235360000006c"
-            "63686163686132302d706f6c7931333035406f70656e7373682e636f6d2c6165"
-            "733132382d6374722c6165733139322d6374722c6165733235362d6374722c61"
-            "65733132382d67636d406f70656e7373682e636f6d2c6165733235362d67636d"
-            "406f70656e7373682e636f6d0000006c63686163686132302d706f6c79313330"
-            "35406f70656e7373682e636f6d2c6165733132382d6374722c6165733139322d"
-            "6374722c6165733235362d6374722c6165733132382d67636d406f70656e7373"
-            "682e636f6d2c6165733235362d67636d406f70656e7373682e636f6d000000d5"
-            "756d61632d36342d65746d406f70656e7373682e636f6d2c756d61632d313238"
-            "2d65746d406f70656e7373682e636f6d2c686d61632d736861322d3235362d65"
-            "746d406f70656e7373682e636f6d2c686d61632d736861322d3531322d65746d"
-            "406f70656e7373682e636f6d2c686d61632d736861312d65746d406f70656e73"
-            "73682e636f6d2c756d61632d3634406f70656e7373682e636f6d2c756d61632d"
-            "313238406f70656e7373682e636f6d2c686d61632d736861322d3235362c686d"
-            "61632d736861322d3531322c686d61632d73686131000000d5756d61632d3634"
-            "2d65746d406f70656e7373682e636f6d2c756d61632d3132382d65746d406f70"
-            "656e7373682e636f6d2c686d61632d736861322d3235362d65746d406f70656e"
-            "7373682e636f6d2c686d61632d736861322d3531322d65746d406f70656e7373"
-            "682e636f6d2c686d61632d736861312d65746d406f70656e7373682e636f6d2c"
-            "756d61632d3634406f70656e7373682e636f6d2c756d61632d313238406f7065"
-            "6e7373682e636f6d2c686d61632d736861322d3235362c686d61632d73686132"
-            "2d3531322c686d61632d736861310000001a6e6f6e652c7a6c6962406f70656e"
-            "7373682e636f6d2c7a6c69620000001a6e6f6e652c7a6c6962406f70656e7373"
-            "682e636f6d2c7a6c696200000000000000000000000000"
-        )
+    # Hard-coded Key Exchange Init message from a OpenSSH 9.5 client.
+    # It can be used in server, because server and client uses the same
+    # format.
+    OPENSSH_KEX: bytes = bytes.fromhex(
+        "1417a3abdb8fa4d9ba63aea67651cbc85b00000114736e747275703736317832"
+        "353531392d736861353132406f70656e7373682e636f6d2c6375727665323535"
+        "31392d7368613235362c637572766532353531392d736861323536406c696273"
+        "73682e6f72672c656364682d736861322d6e697374703235362c656364682d73"
+        "6861322d6e697374703338342c656364682d736861322d6e697374703532312c"
+        "6469666669652d68656c6c6d616e2d67726f75702d65786368616e67652d7368"
+        "613235362c6469666669652d68656c6c6d616e2d67726f757031362d73686135"
+        "31322c6469666669652d68656c6c6d616e2d67726f757031382d736861353132"
+        "2c6469666669652d68656c6c6d616e2d67726f757031342d7368613235362c65"
+        "78742d696e666f2d63000001cf7373682d656432353531392d636572742d7630"
+        "31406f70656e7373682e636f6d2c65636473612d736861322d6e697374703235"
+        "362d636572742d763031406f70656e7373682e636f6d2c65636473612d736861"
+        "322d6e697374703338342d636572742d763031406f70656e7373682e636f6d2c"
+        "65636473612d736861322d6e697374703532312d636572742d763031406f7065"
+        "6e7373682e636f6d2c736b2d7373682d656432353531392d636572742d763031"
+        "406f70656e7373682e636f6d2c736b2d65636473612d736861322d6e69737470"
+        "3235362d636572742d763031406f70656e7373682e636f6d2c7273612d736861"
+        "322d3531322d636572742d763031406f70656e7373682e636f6d2c7273612d73"
+        "6861322d3235362d636572742d763031406f70656e7373682e636f6d2c737368"
+        "2d656432353531392c65636473612d736861322d6e697374703235362c656364"
+        "73612d736861322d6e697374703338342c65636473612d736861322d6e697374"
+        "703532312c736b2d7373682d65643235353139406f70656e7373682e636f6d2c"
+        "736b2d65636473612d736861322d6e69737470323536406f70656e7373682e63"
+        "6f6d2c7273612d736861322d3531322c7273612d736861322d3235360000006c"
+        "63686163686132302d706f6c7931333035406f70656e7373682e636f6d2c6165"
+        "733132382d6374722c6165733139322d6374722c6165733235362d6374722c61"
+        "65733132382d67636d406f70656e7373682e636f6d2c6165733235362d67636d"
+        "406f70656e7373682e636f6d0000006c63686163686132302d706f6c79313330"
+        "35406f70656e7373682e636f6d2c6165733132382d6374722c6165733139322d"
+        "6374722c6165733235362d6374722c6165733132382d67636d406f70656e7373"
+        "682e636f6d2c6165733235362d67636d406f70656e7373682e636f6d000000d5"
+        "756d61632d36342d65746d406f70656e7373682e636f6d2c756d61632d313238"
+        "2d65746d406f70656e7373682e636f6d2c686d61632d736861322d3235362d65"
+        "746d406f70656e7373682e636f6d2c686d61632d736861322d3531322d65746d"
+        "406f70656e7373682e636f6d2c686d61632d736861312d65746d406f70656e73"
+        "73682e636f6d2c756d61632d3634406f70656e7373682e636f6d2c756d61632d"
+        "313238406f70656e7373682e636f6d2c686d61632d736861322d3235362c686d"
+        "61632d736861322d3531322c686d61632d73686131000000d5756d61632d3634"
+        "2d65746d406f70656e7373682e636f6d2c756d61632d3132382d65746d406f70"
+        "656e7373682e636f6d2c686d61632d736861322d3235362d65746d406f70656e"
+        "7373682e636f6d2c686d61632d736861322d3531322d65746d406f70656e7373"
+        "682e636f6d2c686d61632d736861312d65746d406f70656e7373682e636f6d2c"
+        "756d61632d3634406f70656e7373682e636f6d2c756d61632d313238406f7065"
+        "6e7373682e636f6d2c686d61632d736861322d3235362c686d61632d73686132"
+        "2d3531322c686d61632d736861310000001a6e6f6e652c7a6c6962406f70656e"
+        "7373682e636f6d2c7a6c69620000001a6e6f6e652c7a6c6962406f70656e7373"
+        "682e636f6d2c7a6c696200000000000000000000000000"
+    )
 
-    async def handle_client(self, writer: TarpitWriter):
+    def stream(self):
         # later_rate = writer.rate
         # if writer.rate < 128:
         # Change to a faster rate to send the KEX handshake
@@ -1282,11 +4683,9 @@ class SshTransHoldTarpit(SshTarpit):
         # Send identifier
         # RFC 4253:
         # Key exchange will begin immediately after sending this identifier.
-        await writer.write_and_drain(self.SSH_VERSION_STRING)
+        yield self.SSH_VERSION_STRING
         # Send a hard-coded key-exchange message
-        payload = self.OPENSSH_KEX
-        packet = self.make_ssh_packet(payload)
-        await writer.write_and_drain(packet)
+        yield self._kex_packet
 
         # RFC 4253:
         # Once a party has sent a SSH_MSG_KEXINIT message for key exchange or
@@ -1295,12 +4694,21 @@ class SshTransHoldTarpit(SshTarpit):
         # * Transport layer generic messages (1 to 19) (but
         #   SSH_MSG_SERVICE_REQUEST and SSH_MSG_SERVICE_ACCEPT MUST NOT be
         #   sent);
-        while True:
-            # writer.change_rate_limit(later_rate)
-            # SSH_MSG_IGNORE is allowed,
-            # so keep sending this will keep connection open
-            packet = self.make_ssh_packet(self.make_ssh_msg_ignore(16))
-            await writer.write_and_drain(packet)
+        #
+        # SSH_MSG_IGNORE is allowed,
+        # so keep sending this will keep connection open
+        # writer.change_rate_limit(later_rate)
+        yield from self._ignore_frames.batches()
+
+    def _setup(self):
+        super()._setup()
+        self._kex_packet = bytes(self.make_ssh_packet(self.OPENSSH_KEX))
+        self._ignore_frames = FramePool(
+            [
+                bytes(self.make_ssh_packet(self.make_ssh_msg_ignore(length)))
+                for length in range(8, 64, 4)
+            ]
+        )
 
     pass
 
@@ -1308,9 +4716,12 @@ class SshTransHoldTarpit(SshTarpit):
 class SshEndlessTarpit(SshTarpit):
     PATTERN_NAME: str = "endlessh"
 
-    async def handle_client(self, writer: TarpitWriter):
-        while True:
-            await writer.write_and_drain(b"%x\r\n" % random.randint(0, 2**32))
+    def _setup(self):
+        super()._setup()
+        self._lines = LineStream(b"%s\r\n")
+
+    def stream(self):
+        return self._lines.chunks()
 
 
 class TlsTarpit(StaticTarpit):
@@ -1378,10 +4789,12 @@ class TlsHelloRequestTarpit(TlsTarpit):
         h = cls.make_handshake_frag(cls.TlsHandshakeType.HELLO_REQUEST, b"")
         return cls.make_record(cls.TlsRecordContentType.HANDSHAKE, h)
 
-    async def handle_client(self, writer: TarpitWriter):
-        while True:
-            packet = self.make_hello_request_record()
-            await writer.write_and_drain(packet)
+    def _setup(self):
+        super()._setup()
+        self._frames = FramePool([self.make_hello_request_record()])
+
+    def stream(self):
+        return self._frames.batches()
 
     pass
 
@@ -1447,11 +4860,22 @@ class TlsSlowHelloTarpit(TlsTarpit):
 
     async def handle_client(self, writer: TarpitWriter):
         while True:
-            await writer.write_and_drain(self._packet)
+            await writer.send_static(self._packet_id)
+
+    def stream(self):
+        if self._config.rate_limit == 0:
+            return None  # Sent with sendfile() from handle_client()
+        return self._hello_stream()
+
+    def _hello_stream(self):
+        packet, _, _ = StaticBuffer.get(self._packet_id)
+        while True:
+            yield packet
 
     def _setup(self):
         super()._setup()
         self._packet = self.make_server_hello_record()
+        self._packet_id = StaticBuffer.register(self._packet)
 
     pass
 
@@ -1476,12 +4900,13 @@ class FtpTarpit(StaticTarpit):
 class FtpEndlessMotdTarpit(FtpTarpit):
     PATTERN_NAME: str = "ftp_endless_motd"
 
-    async def handle_client(self, writer: TarpitWriter):
-        await writer.write_and_drain(b"230-NOTICE: \r\n")
-        while True:
-            await writer.write_and_drain(
-                b"230-%x\r\n" % random.randint(0, 2**32)
-            )
+    def _setup(self):
+        super()._setup()
+        self._lines = LineStream(b"230-%s\r\n")
+
+    def stream(self):
+        yield b"230-NOTICE: \r\n"
+        yield from self._lines.chunks()
 
 
 class SmtpTarpit(StaticTarpit):
@@ -1504,27 +4929,218 @@ class SmtpTarpit(StaticTarpit):
 class SmtpEndlessEhloTarpit(SmtpTarpit):
     PATTERN_NAME: str = "smtp_endless_ehlo"
 
-    async def handle_client(self, writer: TarpitWriter):
-        await writer.write_and_drain(
-            b"250-[127.0.0.1] Hello [192.168.1.1], pleased to meet you \r\n"
-        )
-        while True:
-            await writer.write_and_drain(
-                b"250-%x\r\n" % random.randint(0, 2**32)
+    def _setup(self):
+        super()._setup()
+        self._lines = LineStream(b"250-%s\r\n")
+
+    def stream(self):
+        yield b"250-[127.0.0.1] Hello [192.168.1.1], pleased to meet you \r\n"
+        yield from self._lines.chunks()
+
+
+class MetricsServer:
+    """
+    A small HTTP server exposing the counters of tarpits in the
+    Prometheus text format, at /metrics.
+
+    Values are read from TarpitStats when scraped, so serving metrics
+    costs nothing on the connection path.
+    """
+
+    def __init__(self, tarpits: list[BaseTarpit]) -> None:
+        self.tarpits = tarpits
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        pairs = []
+        for key, value in labels.items():
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            pairs.append('{}="{}"'.format(key, value.replace("\n", "\\n")))
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> str:
+        metrics: dict[str, tuple[str, str, list[str]]] = {}
+
+        def add(name, kind, help, labels, value, suffix=""):
+            if name not in metrics:
+                metrics[name] = (kind, help, [])
+            metrics[name][2].append(
+                "{}{}{} {}".format(name, suffix, self._labels(**labels), value)
+            )
+
+        for pit in self.tarpits:
+            stats = pit.stats
+            tarpit = {"name": pit._config.name, "pattern": pit.PATTERN_NAME}
+            add(
+                "tarpitd_connections",
+                "gauge",
+                "Connections holding a slot.",
+                tarpit,
+                len(pit._clients),
+            )
+            add(
+                "tarpitd_waiters",
+                "gauge",
+                "Connections waiting for a slot.",
+                tarpit,
+                len(pit._waiters),
             )
+            add(
+                "tarpitd_parked",
+                "gauge",
+                "Connections parked because the client stopped reading.",
+                tarpit,
+                stats.parked,
+            )
+            add(
+                "tarpitd_accepted_total",
+                "counter",
+                "Accepted connections.",
+                tarpit,
+                stats.accepted,
+            )
+            for reason, value in stats.rejected.items():
+                add(
+                    "tarpitd_rejected_total",
+                    "counter",
+                    "Connections rejected by admission control.",
+                    tarpit | {"reason": reason},
+                    value,
+                )
+            add(
+                "tarpitd_sent_bytes_total",
+                "counter",
+                "Bytes sent to clients.",
+                tarpit,
+                stats.bytes_sent,
+            )
+            for result, value in (
+                ("pass", stats.validation_passed),
+                ("fail", stats.validation_failed),
+            ):
+                add(
+                    "tarpitd_validations_total",
+                    "counter",
+                    "Client validation results.",
+                    tarpit | {"result": result},
+                    value,
+                )
+            for error, value in stats.conn_errors.items():
+                add(
+                    "tarpitd_connection_errors_total",
+                    "counter",
+                    "Connections ended by an error.",
+                    tarpit | {"error": error},
+                    value,
+                )
+            add(
+                "tarpitd_dead_peers_reclaimed_total",
+                "counter",
+                "Connections closed by TCP_USER_TIMEOUT or keepalive.",
+                tarpit,
+                stats.dead_peer_reclaimed,
+            )
+            add(
+                "tarpitd_parked_total",
+                "counter",
+                "Connections parked since start.",
+                tarpit,
+                stats.parked_total,
+            )
+            if pit._config.analytics:
+                unique, top = pit.analytics_summary()
+                add(
+                    "tarpitd_unique_sources",
+                    "gauge",
+                    "Estimated number of distinct source addresses.",
+                    tarpit,
+                    unique,
+                )
+                for address, seconds, error in top:
+                    add(
+                        "tarpitd_top_source_seconds",
+                        "gauge",
+                        "Sources which held connections the longest.",
+                        tarpit | {"source": address},
+                        round(seconds, 3),
+                    )
+            name = "tarpitd_connection_duration_seconds"
+            help = "Time connections were held."
+            count = 0
+            bounds = [str(b) for b in stats.DURATION_BUCKETS] + ["+Inf"]
+            for bound, value in zip(bounds, stats.duration_buckets):
+                count += value  # Buckets are cumulative in Prometheus
+                add(
+                    name,
+                    "histogram",
+                    help,
+                    tarpit | {"le": bound},
+                    count,
+                    "_bucket",
+                )
+            add(name, "histogram", help, tarpit, stats.duration_sum, "_sum")
+            add(name, "histogram", help, tarpit, count, "_count")
+
+        lines = []
+        for name, (kind, help, samples) in metrics.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    async def _handler(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            path = head.split(b" ", 2)[1] if head.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status = b"200 OK"
+                body = self.render().encode()
+            else:
+                status = b"404 Not Found"
+                body = b"Not Found\n"
+            writer.write(
+                b"HTTP/1.1 %s\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n%s" % (status, len(body), body)
+            )
+            await writer.drain()
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def create_server(self, host, port, reuse_port=False):
+        return await asyncio.start_server(
+            self._handler, host=host, port=port, reuse_port=reuse_port or None
+        )
 
 
 async def async_run_server(server):
+    async def serve(i):
+        # Every server starts on its own, some wait for their content
+        try:
+            s = await i
+        except OSError as e:
+            logging.error("failed to run server. err: `%s`", e)
+            return
+        except Exception:
+            # Like failing content generation, the other servers go on
+            logging.exception("failed to set up server")
+            return
+        addr = s.sockets[0].getsockname()
+        logging.debug(f"asyncio serving on {addr}")
+        await s.serve_forever()
+
     try:
         async with asyncio.TaskGroup() as tg:
             for i in server:
-                try:
-                    s = await i
-                    addr = s.sockets[0].getsockname()
-                    logging.debug(f"asyncio serving on {addr}")
-                    tg.create_task(s.serve_forever())
-                except OSError as e:
-                    logging.error("failed to run server. err: `%s`", e)
+                tg.create_task(serve(i))
     except asyncio.CancelledError:
         logging.warning(
             "`async_run_server` task cancelled. shutting down tarpitd."
@@ -1534,8 +5150,112 @@ async def async_run_server(server):
 
 
 def run_server(server):
-    with asyncio.Runner() as runner:
-        runner.run(async_run_server(server))
+    import signal
+
+    async def main():
+        # Stop like on SIGINT, so the client trace is written out
+        task = asyncio.current_task()
+        assert task is not None
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, task.cancel
+            )
+        except NotImplementedError:
+            pass  # Windows
+        await async_run_server(server)
+
+    try:
+        with asyncio.Runner() as runner:
+            runner.run(main())
+    finally:
+        if ClientTraceWriter.process_wide is not None:
+            ClientTraceWriter.process_wide.close()
+
+
+def run_workers(
+    binds: list[tuple[BaseTarpit, str, str]],
+    workers: int,
+    metrics_binds: list[tuple[MetricsServer, str, int]] | None = None,
+):
+    """
+    Fork "workers" processes, each one binds every address in binds with
+    SO_REUSEPORT, so the kernel spreads accepted connections across them.
+
+    Every worker has its own counters, worker N serves its metrics on
+    the port in metrics_binds plus N.
+
+    The parent process only supervises, and restarts workers which died
+    abnormally.
+    """
+    import signal
+
+    children: dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            # run_server() handles SIGTERM once its loop is running
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                run_server(
+                    [
+                        pit.create_server(host=host, port=port, reuse_port=True)
+                        for pit, host, port in binds
+                    ]
+                    + [
+                        metrics.create_server(host=host, port=port + index)
+                        for metrics, host, port in metrics_binds or []
+                    ]
+                )
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        children[pid] = index
+        logging.info("worker %d started, pid %d", index, pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn(i)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        if stopping or os.waitstatus_to_exitcode(status) == 0:
+            logging.info("worker %d (pid %d) exited", index, pid)
+            continue
+        logging.error(
+            "worker %d (pid %d) died with status %d, restarting",
+            index,
+            pid,
+            os.waitstatus_to_exitcode(status),
+        )
+        time.sleep(1)  # Do not spin if the worker keeps crashing
+        if not stopping:
+            spawn(index)
+    logging.info("shutdown complete.")
 
 
 def run_from_cli(args):
@@ -1587,6 +5307,9 @@ def run_from_cli(args):
     if args.verbose >= 3:
         logging.error("higher verbose level is not implemented")
 
+    if args.workers:
+        config["workers"] = args.workers
+
     run_from_config_dict(config)
 
 
@@ -1687,9 +5410,16 @@ def run_from_config_dict(config: dict):
             "level": "info",
             "fmt": "[%(levelname)-8s] %(message)s",
             "client_trace": "<stdout>",
+            "client_trace_queue": 65536,
+            "client_trace_overflow": "drop",
+            "client_trace_sample": 16,
+            "client_trace_report": 60,
+            "client_trace_format": "jsonl",
         },
+        "workers": 1,
     }
     server = []
+    binds: list[tuple[BaseTarpit, str, str]] = []
 
     merged_config = dict_deep_update(
         DEFAULT_CONF, config, copy_dest=True, list_strategy="extend"
@@ -1719,12 +5449,15 @@ def run_from_config_dict(config: dict):
 
     # Setup client trace logger
     if ct_enabled:
-        ct_logger = logging.getLogger(__name__ + ".client_trace")
-        ct_logger.propagate = False
-        handler = get_log_handler(merged_config["logging"]["client_trace"])
-        formatter = logging.Formatter("%(message)s")
-        handler.setFormatter(formatter)
-        ct_logger.addHandler(handler)
+        log_conf = merged_config["logging"]
+        ClientTraceWriter.process_wide = ClientTraceWriter(
+            log_conf["client_trace"],
+            max_queue=log_conf["client_trace_queue"],
+            overflow=log_conf["client_trace_overflow"],
+            sample=log_conf["client_trace_sample"],
+            report=log_conf["client_trace_report"],
+            trace_format=log_conf["client_trace_format"],
+        )
         logging.info(
             "saving client trace to `%s`",
             merged_config["logging"]["client_trace"],
@@ -1732,6 +5465,24 @@ def run_from_config_dict(config: dict):
     else:
         logging.info("no tarpit configured with client_trace, will not log it")
 
+    workers = merged_config["workers"]
+    if merged_config.get("content_cache"):
+        ContentCache.directory = merged_config["content_cache"]
+        logging.info("caching generated content in `%s`", ContentCache.directory)
+    if workers > 1 and not hasattr(os, "fork"):
+        logging.error("workers is not supported on this platform, ignored")
+        workers = 1
+
+    if merged_config.get("bandwidth"):
+        TokenBucket.process_wide = TokenBucket(
+            merged_config["bandwidth"] / workers,
+            merged_config.get("bandwidth_burst", 0),
+        )
+        logging.info("process-wide bandwidth: %s", merged_config["bandwidth"])
+
+    # Content is generated in parallel while the tarpits are set up
+    ContentJobs.start()
+
     tarpit_classes: list[BaseTarpit] = get_all_subclasses(BaseTarpit)
     available_tarpits: dict[str, typing.Any] = {}
     # set this to dict[str,BaseTarpit] will make mypy complain
@@ -1752,9 +5503,24 @@ def run_from_config_dict(config: dict):
         real_tarpit_conf.pop("bind")  # Remove it since its useless
 
         if available_tarpits.get(tarpit_config["pattern"]):
-            pit: BaseTarpit = available_tarpits[tarpit_config["pattern"]](
-                **real_tarpit_conf
-            )
+            tarpit_class = available_tarpits[tarpit_config["pattern"]]
+            if workers > 1:
+                # max_clients is a global value, share it between workers
+                real_tarpit_conf["max_clients"] = math.ceil(
+                    tarpit_config.get(
+                        "max_clients", tarpit_class.RuntimeConfig.max_clients
+                    )
+                    / workers
+                )
+                if tarpit_config.get("bandwidth"):
+                    real_tarpit_conf["bandwidth"] = (
+                        tarpit_config["bandwidth"] / workers
+                    )
+            try:
+                pit: BaseTarpit = tarpit_class(**real_tarpit_conf)
+            except ValueError as e:
+                logging.error("invalid config of %s: %s", name, e)
+                exit()
         else:
             logging.error(
                 "pattern %s does not exist!", tarpit_config["pattern"]
@@ -1766,11 +5532,44 @@ def run_from_config_dict(config: dict):
             "tarpitd is serving %s (%s)", tarpit_config["pattern"], name
         )
         for i in tarpit_config["bind"]:
-            server.append(pit.create_server(host=i["host"], port=i["port"]))
-
+            binds.append((pit, i["host"], i["port"]))
+
+    # Jobs are all declared. Workers are forked once the content is ready,
+    # so they share it, and no thread of the pool is left running.
+    ContentJobs.close(wait=workers > 1)
+
+    metrics_binds: list[tuple[MetricsServer, str, int]] = []
+    if merged_config.get("metrics"):
+        metrics = MetricsServer(list(dict.fromkeys(b[0] for b in binds)))
+        for i in merged_config["metrics"]["bind"]:
+            metrics_binds.append((metrics, i["host"], int(i["port"])))
+            logging.info("serving metrics on %s:%s", i["host"], i["port"])
+
+    if workers > 1:
+        for pit in dict.fromkeys(b[0] for b in binds):
+            if isinstance(pit, HttpPreGeneratedTarpit):
+                try:
+                    pit.wait_content()
+                except Exception:
+                    logging.exception("failed to generate content")
+                    binds = [b for b in binds if b[0] is not pit]
+        run_workers(binds, workers, metrics_binds)
+        return
+    for pit, host, port in binds:
+        server.append(pit.create_server(host=host, port=port))
+    for metrics, host, port in metrics_binds:
+        server.append(metrics.create_server(host=host, port=port))
     run_server(server)
 
 
+def convert_trace(source: typing.BinaryIO, dest: typing.TextIO):
+    """
+    Convert a binary client trace to jsonl, one block at a time.
+    """
+    for event in ClientTraceWriter.read_blocks(source):
+        dest.write(ClientTraceWriter.format(event) + "\n")
+
+
 def display_manual_unix(name):
     import subprocess
 
@@ -1851,6 +5650,15 @@ def main_cli():
         nargs="+",
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of worker processes",
+        metavar="N",
+        type=int,
+        default=None,
+    )
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -1858,6 +5666,13 @@ def main_cli():
         action="count",
     )
 
+    parser.add_argument(
+        "--convert-trace",
+        help="convert a binary client trace to jsonl on stdout",
+        metavar="FILE",
+        type=argparse.FileType("rb"),
+    )
+
     parser.add_argument(
         "--manual",
         help="show full manual of this program",
@@ -1871,13 +5686,22 @@ def main_cli():
     if args.manual:
         display_manual_unix(args.manual)
         pass
+    elif args.convert_trace:
+        try:
+            convert_trace(args.convert_trace, sys.stdout)
+        except ValueError as e:
+            print("failed to convert trace: {}".format(e), file=sys.stderr)
+            exit(1)
     elif args.config:
         import tomllib
 
         if args.serve:
             print("--serve conflicts with --config")
             exit()
-        run_from_config_dict(tomllib.load(args.config))
+        config = tomllib.load(args.config)
+        if args.workers:
+            config["workers"] = args.workers
+        run_from_config_dict(config)
     elif args.serve:
         run_from_cli(args)
     else:
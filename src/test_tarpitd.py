@@ -3,6 +3,18 @@ import asyncio
 import tarpitd
 import time
 import typing
+import socket
+import sys
+import os
+import re
+import gc
+import tempfile
+import json
+import queue
+import io
+import zlib
+import signal
+import subprocess
 
 
 class TestTarpit(unittest.IsolatedAsyncioTestCase):
@@ -71,6 +83,73 @@ class TestRateLimitNegative(TestTarpit):
         self.addAsyncCleanup(self.on_cleanup)
 
 
+class TestRateLimitNegativeWheel(TestRateLimitNegative):
+    def create_tarpit_obj(self):
+        t = tarpitd.EndlessBannerTarpit(rate_limit=-2, pacing="wheel")
+        return t
+
+
+class TestRateLimitPositiveWheel(TestRateLimitPositive):
+    def create_tarpit_obj(self):
+        t = tarpitd.EndlessBannerTarpit(rate_limit=2, pacing="wheel")
+        return t
+
+
+class TestPacingWheel(unittest.IsolatedAsyncioTestCase):
+    async def test_one_timer(self):
+        pit = tarpitd.EndlessBannerTarpit(rate_limit=-1, pacing="wheel")
+        server = await pit.create_server("127.0.0.2", 0)
+        await server.start_serving()
+        port = server.sockets[0].getsockname()[1]
+        clients = [
+            await asyncio.open_connection("127.0.0.2", port) for _ in range(5)
+        ]
+        loop = asyncio.get_running_loop()
+        wheel = tarpitd.PacingWheel.get()
+        t1 = loop.time()
+        for _ in range(3):
+            await asyncio.sleep(0.95)
+            timers = [
+                h
+                for h in loop._scheduled  # type: ignore
+                if not h.cancelled() and h._callback == wheel._run
+            ]
+            self.assertEqual(len(timers), 1)
+        # 1 byte every second, without drifting
+        await asyncio.gather(*(r.readexactly(3) for r, _ in clients))
+        self.assertLess(loop.time() - t1, 3.2)
+        for _, writer in clients:
+            writer.close()
+        server.close()
+
+
+class TestRateLimitNegativeProtocol(TestRateLimitNegative):
+    def create_tarpit_obj(self):
+        t = tarpitd.EndlessBannerTarpit(rate_limit=-2, backend="protocol")
+        return t
+
+
+class TestKernelPacing(TestTarpit):
+    def create_tarpit_obj(self):
+        t = tarpitd.EndlessBannerTarpit(rate_limit=-8)
+        return t
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "linux only")
+    async def test_socket_option(self):
+        reader, writer = await asyncio.open_connection("127.0.0.2", self.port)
+        t = tarpitd.TarpitWriter(2048, writer, pacing="kernel")
+        sock = writer.get_extra_info("socket")
+        rate = sock.getsockopt(socket.SOL_SOCKET, tarpitd.SO_MAX_PACING_RATE)
+        self.assertEqual(rate, 2048)
+        self.assertEqual(t.write_and_drain, t._write_normal)
+        t.change_rate_limit(-2)
+        rate = sock.getsockopt(socket.SOL_SOCKET, tarpitd.SO_MAX_PACING_RATE)
+        self.assertEqual(rate & 0xFFFFFFFF, 0xFFFFFFFF)
+        self.assertEqual(t.write_and_drain, t._write_with_interval)
+        writer.close()
+        await writer.wait_closed()
+
+
 class TestHttpTarpit(TestTarpit):
     def create_tarpit_obj(self):
         t = tarpitd.HttpEndlessHeaderTarpit(rate_limit=0)
@@ -126,6 +205,961 @@ class TestTlsSlowHelloTarpit(TestTarpit):
 
 
 
+class TestBandwidth(TestTarpit):
+    def create_tarpit_obj(self):
+        t = tarpitd.EndlessBannerTarpit(
+            rate_limit=0, bandwidth=64, bandwidth_burst=16
+        )
+        return t
+
+    async def test_shared(self):
+        conns = [
+            await asyncio.open_connection("127.0.0.2", self.port)
+            for _ in range(4)
+        ]
+        t1 = time.time()
+        received = [
+            len(data)
+            for data in await asyncio.gather(
+                *(read_with_timeout(r, 1024, 3) for r, _ in conns)
+            )
+        ]
+        t2 = time.time()
+        # 64 B/s shared by 4 clients, plus the burst
+        self.assertLess(sum(received), 64 * (t2 - t1) + 16 + 64)
+        self.assertGreater(min(received), 0)
+        for _, w in conns:
+            w.close()
+            await w.wait_closed()
+
+
+class TestSharedBucket(unittest.IsolatedAsyncioTestCase):
+    async def test_take_turns(self):
+        # Each writer alone could empty the shared bucket in one step
+        parent = tarpitd.TokenBucket(512)
+
+        async def handler(reader, writer):
+            tarpit_writer = tarpitd.TarpitWriter(4096, writer, bucket=parent)
+            try:
+                await tarpit_writer.write_and_drain(b"x" * 2048)
+            except ConnectionError:
+                pass
+            writer.close()
+
+        server = await asyncio.start_server(handler, "127.0.0.2", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+        conns = [
+            await asyncio.open_connection("127.0.0.2", port) for _ in range(2)
+        ]
+        received = [
+            len(data)
+            for data in await asyncio.gather(
+                *(read_with_timeout(r, 2048, 0.5) for r, _ in conns)
+            )
+        ]
+        # Both are served within the first second
+        self.assertGreater(min(received), 0)
+        # The burst, 0.5 s of refill, and a step each
+        self.assertLessEqual(sum(received), 512 + 256 + 2 * 64)
+        for _, w in conns:
+            w.close()
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+    CONFIG: dict = {"rate_limit": -0.2}
+
+    async def serve(self, admission):
+        pit = tarpitd.EndlessBannerTarpit(
+            max_clients=1, admission=admission, **self.CONFIG
+        )
+        server = await pit.create_server("127.0.0.2", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.pit = pit
+        return server.sockets[0].getsockname()[1]
+
+    async def test_reject(self):
+        port = await self.serve("reject")
+        r1, w1 = await asyncio.open_connection("127.0.0.2", port)
+        self.assertTrue(await read_with_timeout(r1, 1, 2))
+        r2, w2 = await asyncio.open_connection("127.0.0.2", port)
+        self.assertEqual(await read_with_timeout(r2, 1, 2), b"")
+        self.assertTrue(r2.at_eof())
+        for w in (w1, w2):
+            w.close()
+
+    async def test_evict_oldest(self):
+        port = await self.serve("evict_oldest")
+        r1, w1 = await asyncio.open_connection("127.0.0.2", port)
+        self.assertTrue(await read_with_timeout(r1, 1, 2))
+        r2, w2 = await asyncio.open_connection("127.0.0.2", port)
+        self.assertTrue(await read_with_timeout(r2, 1, 2))
+        await read_with_timeout(r1, 1024, 1)
+        self.assertTrue(r1.at_eof())
+        for w in (w1, w2):
+            w.close()
+
+    async def test_pause(self):
+        port = await self.serve("pause")
+        r1, w1 = await asyncio.open_connection("127.0.0.2", port)
+        self.assertTrue(await read_with_timeout(r1, 1, 2))
+        r2, w2 = await asyncio.open_connection("127.0.0.2", port)
+        self.assertEqual(await read_with_timeout(r2, 1, 1), b"")
+        # Waiting in the kernel backlog, not in the queue
+        self.assertTrue(self.pit._paused)
+        self.assertEqual(self.pit.stats.accepted, 1)
+        w1.close()
+        # The slot is free once a write finds the client gone
+        self.assertTrue(await read_with_timeout(r2, 1, 4))
+        self.assertEqual(self.pit.stats.accepted, 2)
+        w2.close()
+
+    def test_can_pause(self):
+        # Fails if asyncio internals used by _set_serving() have changed
+        loop = asyncio.SelectorEventLoop()
+        self.addCleanup(loop.close)
+        self.assertTrue(tarpitd.BaseTarpit._can_pause(loop))
+
+
+class TestAdmissionProtocol(TestAdmission):
+    # Served by StaticProtocol, without a task
+    CONFIG = {"rate_limit": -1, "backend": "protocol"}
+
+
+class TestStaticProtocol(unittest.IsolatedAsyncioTestCase):
+    async def serve(self, pit):
+        server = await pit.create_server("127.0.0.2", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return server.sockets[0].getsockname()[1]
+
+    async def test_no_task(self):
+        pit = tarpitd.EndlessBannerTarpit(
+            rate_limit=1024, backend="protocol", client_validation=False
+        )
+        port = await self.serve(pit)
+        tasks = len(asyncio.all_tasks())
+        conns = [
+            await asyncio.open_connection("127.0.0.2", port) for _ in range(3)
+        ]
+        for reader, writer in conns:
+            # More than the recording, reading stops after it
+            writer.write(b"x" * 4096)
+            data = await read_with_timeout(reader, 1024, 2)
+            self.assertEqual(len(data), 1024)
+        self.assertEqual(len(asyncio.all_tasks()), tasks)
+        for record in pit._clients:
+            self.assertIsInstance(record.task, tarpitd.StaticProtocol)
+            self.assertFalse(record.task.transport.is_reading())
+        for _, writer in conns:
+            writer.close()
+        # The first write after close gets a RST, the next one fails
+        await asyncio.sleep(3)
+        self.assertEqual(len(pit._clients), 0)
+        self.assertGreaterEqual(pit.stats.bytes_sent, 3 * 1024)
+        self.assertEqual(pit.stats.duration_buckets[1], 3)
+
+    async def test_validation(self):
+        pit = tarpitd.SmtpEndlessEhloTarpit(rate_limit=4096, backend="protocol")
+        port = await self.serve(pit)
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        self.assertTrue((await reader.readline()).startswith(b"220 "))
+        writer.write(b"EHLO example.com\r\n")
+        self.assertTrue((await reader.readline()).startswith(b"250-"))
+        writer.close()
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        await reader.readline()
+        writer.write(b"QUIT\r\n")
+        self.assertTrue((await reader.readline()).startswith(b"502 "))
+        writer.close()
+        self.assertEqual(pit.stats.validation_passed, 1)
+        self.assertEqual(pit.stats.validation_failed, 1)
+
+    def test_sink_limit(self):
+        class Transport:
+            reading = True
+
+            def pause_reading(self):
+                self.reading = False
+
+        protocol = tarpitd.TarpitProtocol(None)
+        protocol.transport = Transport()  # type: ignore
+        recorded = []
+        protocol.set_sink(recorded.append, 10)
+        protocol.data_received(b"x" * 8)
+        self.assertTrue(protocol.transport.reading)
+        protocol.data_received(b"y" * 8)
+        self.assertFalse(protocol.transport.reading)
+        self.assertEqual(b"".join(recorded), b"x" * 8 + b"yy")
+
+
+class TestSourceLimit(unittest.IsolatedAsyncioTestCase):
+    async def test_per_ip(self):
+        pit = tarpitd.EndlessBannerTarpit(rate_limit=-0.2, max_clients_per_ip=2)
+        server = await pit.create_server("127.0.0.2", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+        conns = [
+            await asyncio.open_connection("127.0.0.2", port) for _ in range(3)
+        ]
+        data = [await read_with_timeout(r, 1, 1) for r, _ in conns]
+        self.assertTrue(data[0] and data[1])
+        self.assertEqual(data[2], b"")
+        for _, w in conns:
+            w.close()
+
+    def test_keys(self):
+        limiter = tarpitd.SourceLimiter(1, 2, prefix_v4=24, prefix_v6=64)
+        a = limiter.keys(("192.0.2.1", 1))
+        b = limiter.keys(("::ffff:192.0.2.2", 1, 0, 0))
+        c = limiter.keys(("192.0.2.3", 1))
+        self.assertIsNone(limiter.acquire(a))
+        self.assertEqual(limiter.acquire(a), "per_ip")
+        self.assertIsNone(limiter.acquire(b))
+        self.assertEqual(limiter.acquire(c), "per_prefix")
+        limiter.release(b)
+        self.assertIsNone(limiter.acquire(c))
+        v6 = limiter.keys(("2001:db8::1", 1, 0, 0))
+        self.assertEqual(v6[1], bytes.fromhex("20010db8") + bytes(12) + b"/")
+
+    def test_independent_rows(self):
+        limiter = tarpitd.SourceLimiter(1)
+        rows: dict[int, set[int]] = {}
+        for i in range(1024):
+            j, k = limiter._indexes(i.to_bytes(4, "big"))
+            rows.setdefault(j, set()).add(k)
+        # Keys which collide in the first row still differ in the second
+        self.assertEqual(sum(map(len, rows.values())), 1024)
+        self.assertLess(len(rows), 1024)
+
+
+class TestSocketOptions(unittest.IsolatedAsyncioTestCase):
+    async def serve(self, **config):
+        pit = tarpitd.EndlessBannerTarpit(client_validation=False, **config)
+        server = await pit.create_server("127.0.0.2", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return pit, server.sockets[0].getsockname()[1]
+
+    @unittest.skipUnless(hasattr(socket, "TCP_USER_TIMEOUT"), "linux only")
+    async def test_apply(self):
+        pit, port = await self.serve(
+            rate_limit=-8,
+            backend="protocol",
+            keepalive=True,
+            tcp_user_timeout=5000,
+            keepidle=30,
+            keepcnt=3,
+        )
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        await asyncio.sleep(0.2)
+        (record,) = pit._clients
+        # The accepted socket, on the side of the tarpit
+        sock = record.task.get_extra_info("socket")
+        self.assertEqual(sock.getsockname(), writer.get_extra_info("peername"))
+        get = sock.getsockopt
+        self.assertTrue(get(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        self.assertEqual(get(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT), 5000)
+        self.assertEqual(get(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 30)
+        self.assertEqual(get(socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 3)
+        writer.close()
+        await writer.wait_closed()
+
+    @unittest.skipUnless(hasattr(socket, "TCP_USER_TIMEOUT"), "linux only")
+    async def test_dead_peer(self):
+        for backend in ("stream", "protocol"):
+            pit, port = await self.serve(
+                rate_limit=0, tcp_user_timeout=1000, backend=backend
+            )
+            # A client which never reads, its receive window drops to zero,
+            # and the zero window probes time out after tcp_user_timeout
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+            sock.setblocking(False)
+            loop = asyncio.get_running_loop()
+            await loop.sock_connect(sock, ("127.0.0.2", port))
+            until = loop.time() + 10
+            while not pit.stats.dead_peer_reclaimed and loop.time() < until:
+                await asyncio.sleep(0.2)
+            self.assertEqual(pit.stats.dead_peer_reclaimed, 1, backend)
+            self.assertEqual(pit.stats.conn_errors["TimeoutError"], 1)
+            self.assertEqual(len(pit._clients), 0)
+
+
+class TestParking(unittest.IsolatedAsyncioTestCase):
+    async def test_park_and_resume(self):
+        stats = tarpitd.TarpitStats()
+        data = b"x" * (8 << 20)
+        done = asyncio.Event()
+
+        async def handler(reader, writer):
+            tarpit_writer = tarpitd.TarpitWriter(
+                0, writer, stall_timeout=0.5, stats=stats
+            )
+            await tarpit_writer.write_and_drain(data)
+            done.set()
+            writer.close()
+
+        server = await asyncio.start_server(handler, "127.0.0.2", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        # Do not read, until the writer is parked
+        await asyncio.sleep(2.5)
+        self.assertEqual(stats.parked, 1)
+        self.assertEqual(stats.parked_total, 1)
+        received = len(await reader.read())
+        await asyncio.wait_for(done.wait(), 5)
+        self.assertEqual(received, len(data))
+        self.assertEqual(stats.parked, 0)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+
+    async def test_no_task(self):
+        pit = tarpitd.EndlessBannerTarpit(
+            rate_limit=0,
+            stall_timeout=0.5,
+            backend="protocol",
+            client_validation=False,
+        )
+        server = await pit.create_server("127.0.0.2", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+        tasks = len(asyncio.all_tasks())
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        await asyncio.sleep(2.5)
+        self.assertEqual(pit.stats.parked, 1)
+        # Parked by StaticProtocol, nothing but the lot waits for it
+        self.assertEqual(len(asyncio.all_tasks()), tasks)
+        loop = asyncio.get_running_loop()
+        until = loop.time() + 2.5
+        while loop.time() < until:
+            await reader.read(1 << 16)
+        self.assertEqual(pit.stats.parked, 0)
+        self.assertEqual(pit.stats.parked_total, 1)
+        writer.close()
+
+
+class TestClientTraceWriter(unittest.IsolatedAsyncioTestCase):
+    async def test_trace_to_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.log")
+            trace_writer = tarpitd.ClientTraceWriter(path)
+            tarpitd.ClientTraceWriter.process_wide = trace_writer
+            self.addCleanup(setattr, tarpitd.ClientTraceWriter, "process_wide", None)
+            pit = tarpitd.EndlessBannerTarpit(rate_limit=-1, client_trace=True)
+            server = await pit.create_server("127.0.0.2", 0)
+            await server.start_serving()
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.2", port)
+            await reader.readexactly(1)
+            writer.close()
+            while pit._clients:  # Noticed on the next write
+                await asyncio.sleep(0.1)
+            server.close()
+            await server.wait_closed()
+            trace_writer.close()
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+        self.assertEqual(events[0]["event"], "open")
+        self.assertEqual(events[0]["pattern"], "endless_banner")
+        self.assertEqual(events[-1]["event"], "close")
+        accounting = events[-1]["meta"]
+        self.assertGreaterEqual(accounting["bytes_sent"], 1)
+        self.assertGreaterEqual(accounting["writes"], 1)
+        self.assertGreaterEqual(accounting["duration"], accounting["drain_time"])
+
+    def test_sigterm(self):
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                self.run_sigterm(workers)
+
+    def run_sigterm(self, workers):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.2", 0))
+            port = sock.getsockname()[1]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.log")
+            config = os.path.join(d, "tarpitd.toml")
+            with open(config, "w") as f:
+                f.write(
+                    "workers = %d\n"
+                    "[tarpits.banner]\n"
+                    'pattern = "endless_banner"\n'
+                    "client_trace = true\n"
+                    "rate_limit = 1\n"
+                    'bind = [{ host = "127.0.0.2", port = %d }]\n'
+                    "[logging]\n"
+                    "client_trace = %s\n" % (workers, port, json.dumps(path))
+                )
+            process = subprocess.Popen(
+                [sys.executable, tarpitd.__file__, "-c", config],
+                stderr=subprocess.DEVNULL,
+            )
+            self.addCleanup(process.kill)
+            clients = []
+            deadline = time.monotonic() + 30
+            while len(clients) < 8 and time.monotonic() < deadline:
+                try:
+                    clients.append(
+                        socket.create_connection(("127.0.0.2", port))
+                    )
+                except ConnectionRefusedError:
+                    time.sleep(0.1)
+            for client in clients:
+                client.settimeout(10)
+                self.assertTrue(client.recv(1))  # Served, so traced
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(30), 0)
+            for client in clients:
+                client.close()
+            with open(path) as f:
+                events = [json.loads(line)["event"] for line in f]
+        self.assertEqual(events.count("open"), 8)
+        self.assertEqual(events.count("close"), 8)
+
+    def test_short_write(self):
+        class Stream(io.BytesIO):
+            def write(self, data):
+                return super().write(data[:3])
+
+        stream = Stream()
+        data = tarpitd.ClientTraceWriter.encode_block(
+            [(1.0, "open", "ssh", "ssh_trans_hold", None, None, None)]
+        )
+        tarpitd.ClientTraceWriter._write(stream, data)
+        self.assertEqual(stream.getvalue(), data)
+
+    async def test_report_idle(self):
+        trace_writer = tarpitd.ClientTraceWriter(os.devnull, report=0.1)
+        trace_writer.put((1.0, "open", "ssh", "ssh_trans_hold", None, None, None))
+        trace_writer.dropped = 3
+        self.addCleanup(trace_writer.close)
+        # Reported without another event
+        with self.assertLogs(level="WARNING") as logs:
+            async with asyncio.timeout(5):
+                while not logs.output:
+                    await asyncio.sleep(0.1)
+        self.assertIn("3 events dropped", logs.output[0])
+
+    def test_overflow(self):
+        for overflow, dropped, sampled in (("drop", 12, 0), ("sample", 0, 12)):
+            trace_writer = tarpitd.ClientTraceWriter(
+                os.devnull, max_queue=8, overflow=overflow, sample=4
+            )
+            # Queue without the writer thread, so nothing is consumed
+            trace_writer._pid = os.getpid()
+            trace_writer._queue = queue.Queue(8)
+            for i in range(20):
+                trace_writer.put((i,))
+            self.assertEqual(trace_writer._queue.qsize(), 8)
+            self.assertEqual(trace_writer.dropped, dropped)
+            self.assertEqual(trace_writer.dropped_sampled, sampled)
+
+
+class TestBinaryTrace(unittest.TestCase):
+    def test_round_trip(self):
+        peer4, sock4 = ("10.1.2.3", 40000), ("127.0.0.1", 22)
+        peer6, sock6 = ("2001:db8::1", 40000, 0, 0), ("::1", 22, 0, 0)
+        events = [
+            (1.5, "open", "ssh", "ssh_trans_hold", peer4, sock4, None),
+            (
+                2.25,
+                "validate",
+                "ssh",
+                "ssh_trans_hold",
+                peer6,
+                sock6,
+                {"expected": False, "data": b"GET /", "comment": None},
+            ),
+            (3.0, "conn_error", "web", "http_ok", peer4, None, {"err": "E"}),
+            (
+                4.0,
+                "close",
+                "web",
+                "http_ok",
+                ("fe80::1%lo", 1, 0, 1),
+                "/tmp/sock",
+                {"request": bytearray(b"\x00\xffGET")},
+            ),
+            (
+                5.0,
+                "close",
+                "web",
+                "http_ok",
+                peer4,
+                sock4,
+                {"request": b"GET /", "bytes_sent": 10, "duration": 1.5},
+            ),
+        ]
+        trace_writer = tarpitd.ClientTraceWriter
+        data = trace_writer.encode_block(events[:2])
+        data += trace_writer.encode_block(events[2:])
+        expected = "".join(trace_writer.format(e) + "\n" for e in events)
+        out = io.StringIO()
+        tarpitd.convert_trace(io.BytesIO(data), out)
+        self.assertEqual(out.getvalue(), expected)
+
+    def test_bad_input(self):
+        with self.assertRaises(ValueError):
+            list(tarpitd.ClientTraceWriter.read_blocks(io.BytesIO(b"{}\n\n\n\n")))
+
+
+class TestMetrics(TestTarpit):
+    def create_tarpit_obj(self):
+        self.pit = tarpitd.EndlessBannerTarpit(
+            name="banner", rate_limit=-0.5, analytics=True
+        )
+        return self.pit
+
+    async def scrape(self, port, path=b"/metrics"):
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        writer.write(b"GET %s HTTP/1.1\r\nHost: x\r\n\r\n" % path)
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def test_scrape(self):
+        reader, writer = await asyncio.open_connection("127.0.0.2", self.port)
+        await reader.readexactly(4)
+        writer.close()
+        while self.pit._clients:
+            await asyncio.sleep(0.1)
+        metrics = tarpitd.MetricsServer([self.pit])
+        server = await metrics.create_server("127.0.0.2", 0)
+        port = server.sockets[0].getsockname()[1]
+        response = await self.scrape(port)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        lines = response.decode().split("\r\n\r\n", 1)[1].splitlines()
+        labels = '{name="banner",pattern="endless_banner"}'
+        self.assertIn("tarpitd_accepted_total" + labels + " 1", lines)
+        self.assertIn("tarpitd_connections" + labels + " 0", lines)
+        self.assertIn(
+            "tarpitd_connection_duration_seconds_count" + labels + " 1", lines
+        )
+        self.assertIn("# TYPE tarpitd_connection_duration_seconds histogram", lines)
+        self.assertIn("tarpitd_unique_sources" + labels + " 1", lines)
+        top = [l for l in lines if l.startswith("tarpitd_top_source_seconds")]
+        self.assertIn('source="127.0.0.1"', top[0])
+        sent = [l for l in lines if l.startswith("tarpitd_sent_bytes_total")]
+        self.assertGreaterEqual(int(sent[0].split()[1]), 4)
+        self.assertTrue(
+            (await self.scrape(port, b"/")).startswith(b"HTTP/1.1 404")
+        )
+        server.close()
+        await server.wait_closed()
+
+    async def test_summary_task(self):
+        task = self.pit._summary_task
+        self.assertIsNotNone(task)
+        self.server.close()
+        await self.server.wait_closed()
+        await asyncio.sleep(0)
+        self.assertTrue(task.done())
+        self.assertIsNone(self.pit._summary_task)
+
+
+class TestSketches(unittest.TestCase):
+    def test_hyperloglog(self):
+        for n in (100, 50000):
+            hll = tarpitd.HyperLogLog()
+            for i in range(n):
+                hll.add(i.to_bytes(4, "big"))
+                hll.add(i.to_bytes(4, "big"))  # Duplicates do not count
+            self.assertLess(abs(hll.count() - n) / n, 0.05)
+
+    def test_space_saving(self):
+        top = tarpitd.SpaceSaving(16)
+        for i in range(10000):
+            top.add(i.to_bytes(4, "big"), 1)
+            if i % 10 == 0:
+                top.add(b"heavy", 30)
+                top.add(b"medium", 10)
+        result = top.top(2)
+        self.assertEqual([key for key, _, _ in result], [b"heavy", b"medium"])
+        weight, error = result[0][1], result[0][2]
+        self.assertLessEqual(weight - error, 30000)
+        self.assertGreaterEqual(weight, 30000)
+        # The heap and the index agree
+        heap = top._heap
+        for pos, counter in enumerate(heap):
+            self.assertEqual(top._index[counter[2]], pos)
+            if pos:
+                self.assertLessEqual(heap[(pos - 1) >> 1][0], counter[0])
+        self.assertEqual(len(top._index), 16)
+
+    def test_pack_address(self):
+        self.assertEqual(
+            tarpitd.pack_address(("::ffff:10.0.0.1", 1, 0, 0)),
+            tarpitd.pack_address(("10.0.0.1", 1)),
+        )
+        self.assertIsNone(tarpitd.pack_address("/tmp/sock"))
+        self.assertEqual(tarpitd.unpack_address(b"\n\0\0\1"), "10.0.0.1")
+
+
+class TestLineStream(unittest.TestCase):
+    def test_chunks(self):
+        lines = tarpitd.LineStream(b"250-%s\r\n")
+        ring_len = len(lines._ring)
+        seen = 0
+        for chunk in lines.chunks():
+            self.assertEqual(len(chunk) % lines.line_len, 0)
+            for line in bytes(chunk).split(b"\r\n")[:-1]:
+                self.assertRegex(line, rb"^250-[0-9a-f]{8}$")
+            seen += len(chunk)
+            if seen > ring_len * 2:  # Wrapped around the ring
+                break
+
+
+class TestFramePool(unittest.TestCase):
+    def test_ssh_ignore_batches(self):
+        pit = tarpitd.SshTransHoldTarpit()
+        batch = bytes(next(pit._ignore_frames.batches()))
+        self.assertGreaterEqual(len(batch), tarpitd.FramePool.BATCH)
+        pos = 0
+        while pos < len(batch):  # Whole SSH_MSG_IGNORE packets only
+            length = int.from_bytes(batch[pos : pos + 4], "big")
+            self.assertEqual((length + 4) % 8, 0)
+            self.assertEqual(batch[pos + 5], 2)
+            pos += 4 + length
+        self.assertEqual(pos, len(batch))
+
+
+class TestSendStatic(unittest.IsolatedAsyncioTestCase):
+    async def send(self, rate, in_file=False):
+        data = os.urandom(100000)
+        if in_file:
+            file = tempfile.TemporaryFile(buffering=0)
+            file.write(b"head\n" + data)
+            buffer_id = tarpitd.StaticBuffer.register(data, file, 5)
+        else:
+            buffer_id = tarpitd.StaticBuffer.register(data)
+        self.addCleanup(tarpitd.StaticBuffer.release, buffer_id)
+        stats = tarpitd.TarpitStats()
+
+        async def handler(reader, writer):
+            tarpit_writer = tarpitd.TarpitWriter(rate, writer, stats=stats)
+            await tarpit_writer.send_static(buffer_id, 10, 50000)
+            await tarpit_writer.send_static(buffer_id, 99990)
+            writer.close()
+
+        server = await asyncio.start_server(handler, "127.0.0.2", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        received = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        self.assertEqual(received, data[10:50010] + data[99990:])
+        self.assertEqual(stats.bytes_sent, 50010)
+
+    async def test_sendfile(self):
+        await self.send(0)
+
+    async def test_fallback(self):
+        await self.send(1 << 20)
+
+    async def test_file_offset(self):
+        await self.send(0, in_file=True)
+
+    async def test_closing(self):
+        buffer_id = tarpitd.StaticBuffer.register(b"x" * 1000)
+        self.addCleanup(tarpitd.StaticBuffer.release, buffer_id)
+        raised = asyncio.get_running_loop().create_future()
+
+        async def handler(reader, writer):
+            tarpit_writer = tarpitd.TarpitWriter(0, writer)
+            writer.close()
+            try:
+                await tarpit_writer.send_static(buffer_id)
+            except Exception as e:
+                raised.set_result(e)
+
+        server = await asyncio.start_server(handler, "127.0.0.2", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.2", port)
+        self.assertIsInstance(
+            await asyncio.wait_for(raised, 5), ConnectionResetError
+        )
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+
+class TestReusePort(unittest.IsolatedAsyncioTestCase):
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "no SO_REUSEPORT")
+    async def test_bind_twice(self):
+        pit = tarpitd.EndlessBannerTarpit(rate_limit=-8)
+        s1 = await pit.create_server("127.0.0.2", 0, reuse_port=True)
+        port = s1.sockets[0].getsockname()[1]
+        s2 = await pit.create_server("127.0.0.2", port, reuse_port=True)
+        self.assertEqual(s2.sockets[0].getsockname()[1], port)
+        for s in (s1, s2):
+            s.close()
+            await s.wait_closed()
+
+
+class TestContentCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        tarpitd.ContentCache.directory = self.tmp.name
+
+    def tearDown(self):
+        tarpitd.ContentCache.directory = None
+        gc.collect()  # Release the shared content of the tarpits
+        self.tmp.cleanup()
+
+    def test_reuse(self):
+        t1 = tarpitd.HttpDeflateHtmlBombTarpit()
+        t2 = tarpitd.HttpDeflateHtmlBombTarpit()
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+        self.assertIsInstance(t2._content_generated.data, memoryview)
+        self.assertEqual(t1._content_generated, t2._content_generated)
+        self.assertEqual(t2._content_generated.encoding, "gzip")
+        self.assertEqual(t1._response_image, t2._response_image)
+        self.assertTrue(
+            bytes(t2._response_image).endswith(t2._content_generated.data)
+        )
+
+    def test_stream_bomb(self):
+        t1 = tarpitd.HttpDeflateStreamBombTarpit()
+        t2 = tarpitd.HttpDeflateStreamBombTarpit()
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+        self.assertEqual(t1._response_id, t2._response_id)
+        image = bytes(t2._response_image)
+        offset = t2._block_offset()
+        # The block is a whole chunk, which can be repeated
+        size, _, rest = image[offset:].partition(b"\r\n")
+        self.assertEqual(len(rest), int(size, 16) + 2)
+
+    def test_not_cached(self):
+        t1 = tarpitd.HttpBadHtmlTarpit()
+        t2 = tarpitd.HttpBadHtmlTarpit()
+        # Shared in memory, but a new random page on the next start
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(t1._response_id, t2._response_id)
+
+    def test_send_from_cache_file(self):
+        t = tarpitd.HttpDeflateHtmlBombTarpit()
+        view, file, offset = tarpitd.StaticBuffer.get(t._response_id)
+        # The cache file itself, not a copy in a memfd
+        self.assertEqual(os.path.dirname(file.name), self.tmp.name)
+        self.assertEqual(os.pread(file.fileno(), len(view), offset), view)
+
+
+class TestContentRegistry(unittest.TestCase):
+    class T(tarpitd.HttpPreGeneratedTarpit):
+        generated = 0
+
+        def _content_key(self):
+            return ("test", type(self).__qualname__)
+
+        def _generate_content(self):
+            type(self).generated += 1
+            return self.Content(b"shared")
+
+    def test_refcount(self):
+        t1, t2 = self.T(), self.T()
+        self.assertEqual(self.T.generated, 1)
+        self.assertIs(t1._response_image, t2._response_image)
+        self.assertEqual(t1._response_id, t2._response_id)
+        buffer_id = t1._response_id
+        del t1
+        gc.collect()
+        self.assertIn(buffer_id, tarpitd.StaticBuffer._buffers)
+        del t2
+        gc.collect()
+        self.assertNotIn(buffer_id, tarpitd.StaticBuffer._buffers)
+        self.assertNotIn(
+            ("test", self.T.__qualname__), tarpitd.ContentRegistry._refs
+        )
+        self.T()
+        self.assertEqual(self.T.generated, 2)
+
+
+class TestMaze(unittest.IsolatedAsyncioTestCase):
+    async def fetch(self, port, request):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request)
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+        return data
+
+    async def test_maze(self):
+        pit = tarpitd.HttpBadHtmlTarpit(rate_limit=0, maze=True, maze_cache=2)
+        server = await pit.create_server("127.0.0.1", 0)
+        await server.start_serving()
+        port = server.sockets[0].getsockname()[1]
+        a = await self.fetch(port, b"GET /a?x=1 HTTP/1.1\r\nHost: a\r\n\r\n")
+        b = await self.fetch(port, b"GET /b HTTP/1.1\r\n\r\n")
+        self.assertTrue(a.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertNotEqual(a, b)
+        for path in (b"/c", b"/d"):
+            await self.fetch(port, b"GET %s HTTP/1.1\r\n\r\n" % path)
+        self.assertEqual(len(pit._maze_pages), 2)
+        # Evicted, but the page of a path never changes
+        self.assertEqual(a, await self.fetch(port, b"GET /a HTTP/1.1\r\n\r\n"))
+        link = re.search(rb"href='(/[0-9a-f]{8}\.html)'", a)
+        self.assertIsNotNone(link)
+        # Not a valid request, the static page is sent
+        self.assertEqual(
+            await self.fetch(port, b"GET nothing\r\n\r\n"),
+            bytes(pit._response_image),
+        )
+        server.close()
+
+
+class TestKeepAlive(unittest.IsolatedAsyncioTestCase):
+    def test_parse(self):
+        parse = tarpitd.HttpTarpit.Request.parse
+        request = parse(b"GET /a HTTP/1.1\r\nHost: x\r\nAccept : */*")
+        assert request is not None
+        self.assertEqual(request.target, b"/a")
+        self.assertEqual(request.headers, {b"host": b"x", b"accept": b"*/*"})
+        self.assertTrue(request.keep_alive)
+        for head in (
+            b"GET / HTTP/1.0",
+            b"GET / HTTP/1.1\r\nConnection: Close",
+            b"POST / HTTP/1.1\r\nContent-Length: 3",
+            b"HEAD / HTTP/1.1",
+        ):
+            self.assertFalse(parse(head).keep_alive)  # type: ignore
+        self.assertIsNone(parse(b"GET nothing"))
+
+    def test_max_requests(self):
+        for max_requests in (0, -1):
+            with self.assertRaises(ValueError):
+                tarpitd.HttpFakeAuthTarpit(max_requests=max_requests)
+
+    async def test_pipelining(self):
+        pit = tarpitd.HttpFakeAuthTarpit(
+            rate_limit=0, keep_alive=True, max_requests=3
+        )
+        server = await pit.create_server("127.0.0.1", 0)
+        await server.start_serving()
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        # Split in the middle of a head, and with one request too many
+        writer.write(b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\nHo")
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        writer.write(b"st: x\r\n\r\n\r\nGET /c HTTP/1.1\r\n\r\nGET /d ")
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), 10)
+        self.assertEqual(data, bytes(pit._response_image) * 3)
+        writer.close()
+
+        # A HEAD response has a body, so nothing follows it
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"HEAD / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n")
+        data = await asyncio.wait_for(reader.read(), 10)
+        self.assertEqual(data, bytes(pit._response_image))
+        writer.close()
+
+        # Served once, when the client asks to close
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n" * 2)
+        data = await asyncio.wait_for(reader.read(), 10)
+        self.assertEqual(data, bytes(pit._response_image))
+        writer.close()
+        server.close()
+
+
+class FailingTarpit(tarpitd.HttpPreGeneratedTarpit):
+    # At module level, so the job can be sent to the pool
+    def _generate_content(self):
+        raise RuntimeError("no content")
+
+
+class TestContentJobs(unittest.IsolatedAsyncioTestCase):
+    async def test_jobs(self):
+        tarpitd.ContentJobs.start()
+        try:
+            t1 = tarpitd.HttpDeflateHtmlBombTarpit()
+            t2 = tarpitd.HttpDeflateHtmlBombTarpit()
+            t3 = tarpitd.HttpBadHtmlTarpit()
+        finally:
+            tarpitd.ContentJobs.close()
+        # Same content key, same job
+        self.assertIs(t1._content_job, t2._content_job)
+        self.assertIsNot(t1._content_job, t3._content_job)
+        self.assertFalse(hasattr(t1, "_response_image"))
+        server = await t1.create_server("127.0.0.1", 0)
+        t2.wait_content()
+        self.assertEqual(t1._response_image, t2._response_image)
+        self.assertEqual(
+            t1._response_image,
+            tarpitd.HttpDeflateHtmlBombTarpit()._response_image,
+        )
+        t3.wait_content()
+        self.assertIn(b"SUPER", bytes(t3._content_generated.data))
+        server.close()
+
+    async def test_bad_config(self):
+        tarpitd.ContentJobs.start()
+        try:
+            for pattern, compression_type in (
+                (tarpitd.HttpDeflateSizeBombTarpit, "br"),
+                (tarpitd.HttpDeflateStreamBombTarpit, "br"),
+                (tarpitd.HttpNestedDeflateBombTarpit, "gzip, br"),
+            ):
+                # Before any job is declared
+                with self.assertRaises(ValueError):
+                    pattern(compression_type=compression_type)
+            self.assertEqual(tarpitd.ContentJobs._jobs, {})
+        finally:
+            tarpitd.ContentJobs.close()
+
+    async def test_failed_job(self):
+        tarpitd.ContentJobs.start()
+        try:
+            failing = FailingTarpit()
+            pit = tarpitd.HttpBadHtmlTarpit()
+        finally:
+            tarpitd.ContentJobs.close()
+        servers = [
+            failing.create_server("127.0.0.1", 0),
+            pit.create_server("127.0.0.1", 0),
+        ]
+        with self.assertLogs(level="ERROR") as logs:
+            task = asyncio.create_task(tarpitd.async_run_server(servers))
+            async with asyncio.timeout(30):
+                while not pit._servers:
+                    await asyncio.sleep(0.1)
+                while not any("no content" in i for i in logs.output):
+                    await asyncio.sleep(0.1)
+        # The other server keeps running
+        self.assertFalse(task.done())
+        self.assertTrue(pit._servers[0].is_serving())
+        task.cancel()
+        await task
+
+
+class TestResponseImage(unittest.IsolatedAsyncioTestCase):
+    class Recorder:
+        def __init__(self):
+            self.data = b""
+
+        async def write_and_drain(self, data):
+            self.data += bytes(data)
+
+    async def test_same_as_connection(self):
+        recorder = self.Recorder()
+        connection = tarpitd.HttpTarpit.Connection(recorder)
+        await connection.send_status_line(401)
+        await connection.send_header(b"WWW-Authenticate", b'Basic realm="Server"')
+        await connection.send_content(b"401 Unauthorized")
+        pit = tarpitd.HttpFakeAuthTarpit()
+        self.assertEqual(pit._response_image, recorder.data)
+
+
 # NEO
 
 
@@ -258,6 +1292,22 @@ class T_HttpOk(NeoTestTarpit):
     ]
 
 
+class T_HttpOkProtocol(NeoTestTarpit):
+    TARPIT = tarpitd.HttpOkTarpit
+    TEST_SET: list[TarpitTestSet] = [
+        TarpitTestSet(
+            request=b"GET ",
+            excepted_response=b"HTTP",
+            config={"rate_limit": 1024, "backend": "protocol"},
+        ),
+        TarpitTestSet(
+            request=b"BAD_",
+            excepted_response=b"",
+            config={"rate_limit": 1024, "backend": "protocol"},
+        ),
+    ]
+
+
 class T_HttpDeflateHtml(NeoTestTarpit):
     TARPIT = tarpitd.HttpDeflateHtmlBombTarpit
 
@@ -293,6 +1343,87 @@ class T_HttpDeflateSize(NeoTestTarpit):
         )
 
 
+class T_HttpDeflateStream(NeoTestTarpit):
+    TARPIT = tarpitd.HttpDeflateStreamBombTarpit
+
+    async def endless_gzip(self, reader, writer):
+        header = await get_http_header(reader)
+        self.assertIn("Transfer-Encoding: chunked", header)
+        self.assertIn("Content-Encoding: gzip", header)
+        decompressor = zlib.decompressobj(31)
+        size = 0
+        for _ in range(4):
+            length = int(await reader.readline(), 16)
+            chunk = await reader.readexactly(length + 2)
+            size += len(decompressor.decompress(chunk[:-2]))
+        self.assertGreater(size, 3 * tarpitd.HttpDeflateStreamBombTarpit.BLOCK_SIZE)
+        self.assertFalse(decompressor.eof)
+
+    TEST_SET: list[TarpitTestSet] = []
+
+    def _setup(self):
+        self.TEST_SET.append(
+            TarpitTestSet(
+                request=b"GET ",
+                excepted_response=self.endless_gzip,
+                config={"rate_limit": 0},
+            )
+        )
+        self.TEST_SET.append(
+            TarpitTestSet(
+                request=b"GET ",
+                excepted_response=self.endless_gzip,
+                config={"rate_limit": 1 << 20, "backend": "protocol"},
+            )
+        )
+
+
+class TestNestedBomb(unittest.TestCase):
+    def test_checksums(self):
+        data = os.urandom(100)
+        for n in (0, 1, 7, 1000, 123457):
+            self.assertEqual(
+                tarpitd.crc32_zeros(zlib.crc32(data), n),
+                zlib.crc32(data + bytes(n)),
+            )
+            self.assertEqual(
+                tarpitd.adler32_zeros(zlib.adler32(data), n),
+                zlib.adler32(data + bytes(n)),
+            )
+
+    def test_layers(self):
+        class T(tarpitd.HttpNestedDeflateBombTarpit):
+            BLOCK_SIZE = 1024**2
+            BLOCKS = 8
+
+        for encoding in ("deflate, gzip", "gzip, gzip", "gzip"):
+            content = T(compression_type=encoding)._content_generated
+            self.assertEqual(content.encoding, encoding)
+            data = bytes(content.data)
+            # Decoded in the reverse order they were applied
+            for layer in reversed(encoding.split(", ")):
+                decompressor = zlib.decompressobj(T.WBITS[layer])
+                data = decompressor.decompress(data)
+                self.assertTrue(decompressor.eof)
+                self.assertFalse(decompressor.unused_data)
+            self.assertEqual(data.count(0), T.BLOCK_SIZE * T.BLOCKS)
+        with self.assertRaises(ValueError):
+            T(compression_type="deflate, br")
+
+    def test_content_key(self):
+        class T(tarpitd.HttpNestedDeflateBombTarpit):
+            BLOCK_SIZE = 1024
+            BLOCKS = 8
+
+        key = T(rate_limit=0)._content_key()
+        for attr, value in (("BLOCK_SIZE", 2048), ("BLOCKS", 16)):
+            with self.subTest(attr=attr):
+                # Same name, only the parameter differs
+                U = type("T", (T,), {attr: value})
+                U.__qualname__ = T.__qualname__
+                self.assertNotEqual(U(rate_limit=0)._content_key(), key)
+
+
 class T_SshValidatorExtra(NeoTestTarpit):
     class T(tarpitd.SshTransHoldTarpit):
         class ValidatorConfig(tarpitd.SshTransHoldTarpit.ValidatorConfig):